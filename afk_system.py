@@ -1,28 +1,16 @@
-import os
-import json
 from datetime import datetime
 from typing import Dict, Optional
 
-AFK_FILE = "afk_data.json"
+from storage import StorageTable
 
 class AFKSystem:
     def __init__(self):
-        self.data = self.load_data()
+        self.table = StorageTable("afk")
+        self.data = self.table.rows
     
-    def load_data(self) -> Dict:
-        """Load AFK data from file"""
-        if os.path.exists(AFK_FILE):
-            try:
-                with open(AFK_FILE, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-        return {}
-    
-    def save_data(self):
-        """Save AFK data to file"""
-        with open(AFK_FILE, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+    def save_data(self, user_id: str):
+        """Schedule a write-behind save of one user's AFK row"""
+        self.table.mark_dirty(user_id)
     
     def set_afk(self, user_id: str, reason: Optional[str] = None):
         """Set user as AFK"""
@@ -30,13 +18,13 @@ class AFKSystem:
             "reason": reason or "AFK",
             "timestamp": datetime.now().isoformat()
         }
-        self.save_data()
+        self.save_data(user_id)
     
     def remove_afk(self, user_id: str) -> Optional[Dict]:
         """Remove AFK status and return the data"""
         if user_id in self.data:
             data = self.data.pop(user_id)
-            self.save_data()
+            self.save_data(user_id)
             return data
         return None
     
@@ -1,16 +1,22 @@
 import os
 import re
 import json
-import requests
+import asyncio
 import logging
 import traceback
+from collections import OrderedDict
 from datetime import datetime
 from dotenv import load_dotenv
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
-# Set để track những message đã xử lý
-processed_message_ids = set()
+from ai_limiter import AdmissionRejected, admission
+from conversation_cache import conversation_cache
+from prompt_builder import prompt_builder
+from nvidia_client import NvidiaAPIError, nvidia_client
+from response_cache import AI_RESPONSE_CACHE, response_cache
+from idempotency import RecentIds
+
+# Track những message đã xử lý (bounded, không bao giờ clear cả cục)
+processed_message_ids = RecentIds(max_size=1000, window_seconds=600)
 
 # Thiết lập logging ra stdout
 logging.basicConfig(
@@ -29,6 +35,22 @@ logger = logging.getLogger(__name__)
 
 current_model = "meta/llama-3.1-8b-instruct"
 
+# Streaming: gửi tin nhắn tạm rồi edit dần khi token về (đổi bằng +aistream)
+stream_replies = os.getenv("AI_STREAMING", "0").strip().lower() in ("1", "true", "on")
+STREAM_PLACEHOLDER = "✍️ ..."
+STREAM_EDIT_INTERVAL = 1.2  # giây giữa 2 lần edit, Discord cho ~5 edit / 5 giây
+DISCORD_MESSAGE_LIMIT = 2000
+
+# Tóm tắt lịch sử cũ khi vượt budget (xem prompt_builder.py)
+SUMMARY_MAX_TOKENS = 120
+MEMORY_CACHE_SIZE = 1000
+_memory_cache = OrderedDict()
+
+# Cache câu trả lời cho tin lặp lại (xem response_cache.py), đổi bằng +aicache
+cache_replies = AI_RESPONSE_CACHE
+TOPIC_CHANGE_PATTERN = re.compile(r"(?i)(?:chuyển|đổi)\s+(?:sang\s+)?chủ đề\s+(.+)")
+EMPTY_REPLY = "(NVIDIA API không trả lời nội dung văn bản)"
+
 # Danh sách user bị cấm
 BLOCKED_USERS = [0]  # Thay ID thực nếu cần
 load_dotenv()
@@ -74,43 +96,16 @@ def save_user_history(user_id, role, content):
         logger.warning("Attempted to save empty content for user %s", user_id)
         return
     
-    os.makedirs("user_histories", exist_ok=True)
-    path = os.path.join("user_histories", f"{user_id}.json")
-    history = []
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                history = json.load(f)
-        except json.JSONDecodeError:
-            history = []
-    
-    history.append({"role": role, "content": content})
-    # Reduce from 50 to 20 for faster API calls
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(history[-20:], f, ensure_ascii=False, indent=2)
+    # Kept in memory (last 20 messages), written to user_histories/ lazily
+    conversation_cache.append(user_id, role, content)
 
 def load_user_history(user_id):
-    path = os.path.join("user_histories", f"{user_id}.json")
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                history = json.load(f)
-                # Filter out empty messages
-                return [
-                    msg for msg in history 
-                    if msg.get("content") and msg.get("content").strip()
-                ]
-        except json.JSONDecodeError:
-            return []
-    return []
+    return conversation_cache.history(user_id)
 
 def clear_user_history(user_id):
     """Clear chat history for a user"""
-    path = os.path.join("user_histories", f"{user_id}.json")
-    if os.path.exists(path):
-        os.remove(path)
-        return True
-    return False
+    prompt_builder.forget(user_id)
+    return conversation_cache.clear(user_id)
 
 def save_user_memory(user_id, key, value):
     """Save a memory/note about a user"""
@@ -129,17 +124,28 @@ def save_user_memory(user_id, key, value):
     }
     with open(memory_path, "w", encoding="utf-8") as f:
         json.dump(memories, f, ensure_ascii=False, indent=2)
+    _memory_cache.pop(user_id, None)
 
 def load_user_memories(user_id):
     """Load all memories about a user"""
+    if user_id in _memory_cache:
+        _memory_cache.move_to_end(user_id)
+        return _memory_cache[user_id]
+
+    memories = {}
     memory_path = os.path.join("user_histories", f"{user_id}_memory.json")
     if os.path.exists(memory_path):
         try:
             with open(memory_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+                memories = json.load(f)
         except json.JSONDecodeError:
-            return {}
-    return {}
+            memories = {}
+
+    # Memories go into every prompt, so keep recent users' memories in RAM
+    _memory_cache[user_id] = memories
+    if len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return memories
 
 def delete_user_memory(user_id, key):
     """Delete a specific memory"""
@@ -152,17 +158,81 @@ def delete_user_memory(user_id, key):
                 del memories[key]
                 with open(memory_path, "w", encoding="utf-8") as f:
                     json.dump(memories, f, ensure_ascii=False, indent=2)
+                _memory_cache.pop(user_id, None)
                 return True
         except json.JSONDecodeError:
             pass
     return False
 
+async def summarize_history(api_key, previous_summary, turns):
+    """Ask the model for a short rolling summary of turns that no longer fit the prompt"""
+    transcript = "\n".join(
+        f"{'Người dùng' if msg.get('role') == 'user' else 'Doro'}: {msg.get('content')}"
+        for msg in turns
+    )
+    if previous_summary:
+        transcript = f"Tóm tắt trước đó: {previous_summary}\n\n{transcript}"
+
+    data = await nvidia_client.chat_completion(
+        api_key,
+        {
+            "model": current_model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": (
+                        "Tóm tắt cuộc trò chuyện sau trong tối đa 3 câu tiếng Việt. "
+                        "Giữ lại sự kiện, sở thích và thông tin quan trọng về người dùng."
+                    )
+                },
+                {"role": "user", "content": transcript}
+            ],
+            "temperature": 0.3,
+            "max_tokens": SUMMARY_MAX_TOKENS,
+        },
+        timeout=30,
+    )
+    choices = data.get("choices") or [{}]
+    content = choices[0].get("message", {}).get("content")
+    return content if isinstance(content, str) else ""
+
+async def stream_reply(message, api_key, payload):
+    """Post a placeholder reply, edit it as tokens arrive and return the full text"""
+    placeholder = await message.channel.send(STREAM_PLACEHOLDER, reference=message)
+    loop = asyncio.get_running_loop()
+    parts = []
+    shown = ""
+    last_edit = float("-inf")  # show the first token right away
+
+    try:
+        async for delta in nvidia_client.stream_chat_completion(api_key, payload, timeout=30):
+            parts.append(delta)
+            now = loop.time()
+            if now - last_edit < STREAM_EDIT_INTERVAL:
+                continue
+            text = "".join(parts).strip()[:DISCORD_MESSAGE_LIMIT - 2]
+            if text and text != shown:
+                await placeholder.edit(content=f"{text} ▌")
+                shown = text
+                last_edit = now
+    except Exception:
+        # Let the caller report the error instead of leaving a dangling placeholder
+        try:
+            await placeholder.delete()
+        except Exception:
+            logger.debug("Không xoá được placeholder", exc_info=True)
+        raise
+
+    reply = "".join(parts).strip()
+    if not reply:
+        logger.error("Empty streamed reply for message %s", message.id)
+        reply = EMPTY_REPLY
+    await placeholder.edit(content=reply[:DISCORD_MESSAGE_LIMIT])
+    return reply
+
 async def ai_handle_message(bot, message):
-    if message.id in processed_message_ids:
+    if processed_message_ids.seen(message.id):
         return
-    processed_message_ids.add(message.id)
-    if len(processed_message_ids) > 1000:
-        processed_message_ids.clear()
 
     if message.author == bot.user:
         return
@@ -182,9 +252,6 @@ async def ai_handle_message(bot, message):
         await message.channel.send(f"Nội dung bạn gửi quá dài (>{MAX_INPUT_CHARS} ký tự)", reference=message)
         return
 
-    save_user_history(user_id, "user", user_input)
-    history_messages = load_user_history(user_id)
-
     image_url = None
     for att in message.attachments:
         if att.filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".gif")):
@@ -195,6 +262,56 @@ async def ai_handle_message(bot, message):
         await message.channel.send("do?", reference=message)
         return
 
+    if is_cacheable(user_input, image_url):
+        is_owner = message.author.id in OWNER_USER_IDS
+        history = load_user_history(user_id)
+        cached = response_cache.get(
+            cache_persona(user_id, build_system_prompt(is_owner=is_owner), history),
+            user_input,
+            history,
+        )
+        if cached:
+            # Served from cache: no LLM call, no admission slot needed
+            save_user_history(user_id, "user", user_input)
+            await message.channel.send(cached, reference=message)
+            save_user_history(user_id, "assistant", cached)
+            return
+
+    try:
+        # Per-user single flight + global cap + NVIDIA rate limit
+        async with admission.slot(user_id):
+            await respond_to_message(message, user_id, user_input, image_url)
+    except AdmissionRejected:
+        logger.warning("AI queue full, rejected message from user %s", user_id)
+        await message.channel.send("Doro đang bận quá, thử lại sau chút nha~ 🐧", reference=message)
+
+def is_cacheable(user_input, image_url):
+    """Plain text without an image or a topic switch can be answered from the reply cache"""
+    return (
+        cache_replies
+        and not image_url
+        and bool(user_input)
+        and not TOPIC_CHANGE_PATTERN.search(user_input)
+    )
+
+def cache_persona(user_id, system_prompt, history):
+    """Persona part of the reply cache key.
+
+    Replies are only shared across users for a fresh conversation: once a user
+    has history (or +remember memories) the reply may mention their names/facts,
+    so the entry is scoped to that user.
+    """
+    memories = load_user_memories(user_id)
+    if not memories and not history:
+        return system_prompt
+    return system_prompt + f"\x00user:{user_id}" + json.dumps(memories, ensure_ascii=False, sort_keys=True)
+
+async def respond_to_message(message, user_id, user_input, image_url):
+    # Past turns only; the current message goes into the prompt tail below
+    past_history = load_user_history(user_id)
+    history_messages = past_history
+    save_user_history(user_id, "user", user_input)
+
     def _to_nvidia_message(entry):
         if not isinstance(entry, dict):
             return {
@@ -221,20 +338,14 @@ async def ai_handle_message(bot, message):
     is_owner = message.author.id in OWNER_USER_IDS
     system_prompt = build_system_prompt(is_owner=is_owner)
 
-    messages = [
-        {
-            "role": "system",
-            "content": system_prompt
-        }
-    ] + [_to_nvidia_message(msg) for msg in history_messages]
-
+    tail = []
     topic_change_instruction = None
-    topic_change_match = re.search(r"(?i)(?:chuyển|đổi)\s+(?:sang\s+)?chủ đề\s+(.+)", user_input)
+    topic_change_match = TOPIC_CHANGE_PATTERN.search(user_input)
     if topic_change_match:
         topic_change_instruction = topic_change_match.group(1).strip().rstrip(".!?,")
 
     if topic_change_instruction:
-        messages.append(
+        tail.append(
             {
                 "role": "system",
                 "content": f"Người dùng vừa yêu cầu đổi chủ đề. Hãy chuyển ngay sang chủ đề: {topic_change_instruction}."
@@ -253,13 +364,24 @@ async def ai_handle_message(bot, message):
             "content": user_input
         }
 
-    messages.append(user_message)
+    tail.append(user_message)
     
     # Filter out any messages with empty content (safety check)
-    messages = [
-        msg for msg in messages 
+    history_messages = [
+        msg for msg in (_to_nvidia_message(entry) for entry in history_messages)
         if msg.get("content") and str(msg.get("content")).strip()
     ]
+    tail = [msg for msg in tail if msg.get("content") and str(msg.get("content")).strip()]
+    
+    # Fit system prompt, +remember memories, summary and newest history into the token budget
+    plan = prompt_builder.build(
+        user_id,
+        system_prompt,
+        history_messages,
+        load_user_memories(user_id),
+        tail,
+    )
+    messages = plan.messages
     
     if len(messages) < 2:  # Need at least system + user message
         logger.error("Not enough valid messages after filtering")
@@ -271,16 +393,13 @@ async def ai_handle_message(bot, message):
         await message.channel.send("⚠️ Thiếu NVIDIA_API_KEY rồi không thể gọi AI được!", reference=message)
         return
 
-    request_url = "https://integrate.api.nvidia.com/v1/chat/completions"
-    session = requests.Session()
-    # Reduce retries from 3 to 2 for faster response
-    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
-    session.mount("https://", HTTPAdapter(max_retries=retry))
+    if plan.folded and plan.summary_stale:
+        async def _summarize(previous_summary, turns):
+            async with admission.slot(f"summary:{user_id}"):
+                return await summarize_history(api_key, previous_summary, turns)
+
+        prompt_builder.schedule_summary(user_id, plan.folded, _summarize)
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "model": current_model,
         "messages": messages,
@@ -289,29 +408,25 @@ async def ai_handle_message(bot, message):
         "top_p": 0.9        # Nucleus sampling for faster generation
     }
 
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    def remember_reply(reply, latency):
+        if reply != EMPTY_REPLY and is_cacheable(user_input, image_url):
+            response_cache.put(
+                cache_persona(user_id, system_prompt, past_history), user_input, past_history, reply, latency
+            )
+
     async with message.channel.typing():
         try:
-            # Reduce timeout from 60 to 30 seconds
-            resp = session.post(request_url, headers=headers, json=payload, timeout=30)
-            if resp.status_code == 404:
-                body = resp.text or "<no body>"
-                logger.error("NVIDIA API 404 at %s", request_url)
-                logger.error("Response body: %s", body)
-                await message.channel.send(
-                    "API NVIDIA trả về 404 (Not Found). Kiểm tra đường dẫn `/v1/chat/completions`.",
-                    reference=message
-                )
-                return
-            if 400 <= resp.status_code < 500:
-                body = resp.text or "<no body>"
-                logger.error("Client error %s from NVIDIA API: %s", resp.status_code, body)
-                await message.channel.send(
-                    f"API trả về lỗi {resp.status_code}: {body[:400]}\nKiểm tra NVIDIA_API_KEY và model.",
-                    reference=message
-                )
+            if stream_replies:
+                reply = await stream_reply(message, api_key, payload)
+                save_user_history(user_id, "assistant", reply)
+                remember_reply(reply, loop.time() - started)
                 return
-            resp.raise_for_status()
-            data = resp.json()
+
+            # Non-blocking: the shared client retries 429/5xx with backoff
+            data = await nvidia_client.chat_completion(api_key, payload, timeout=30)
             if "error" in data:
                 error_entry = data["error"]
                 if isinstance(error_entry, dict):
@@ -360,16 +475,36 @@ async def ai_handle_message(bot, message):
 
             if not reply:
                 logger.error("Empty reply. Full API response: %s", data)
-                reply = "(NVIDIA API không trả lời nội dung văn bản)"
+                reply = EMPTY_REPLY
 
             await message.channel.send(reply, reference=message)
             save_user_history(user_id, "assistant", reply)
-        except requests.HTTPError as http_err:
-            status = http_err.response.status_code if http_err.response else "?"
-            body = http_err.response.text if http_err.response else ""
-            logger.error("HTTPError %s: %s", status, body)
+            remember_reply(reply, loop.time() - started)
+        except NvidiaAPIError as api_err:
+            body = api_err.body or "<no body>"
+            if api_err.status == 404:
+                logger.error("NVIDIA API 404 at %s", nvidia_client.url)
+                logger.error("Response body: %s", body)
+                await message.channel.send(
+                    "API NVIDIA trả về 404 (Not Found). Kiểm tra đường dẫn `/v1/chat/completions`.",
+                    reference=message
+                )
+            elif 400 <= api_err.status < 500:
+                logger.error("Client error %s from NVIDIA API: %s", api_err.status, body)
+                await message.channel.send(
+                    f"API trả về lỗi {api_err.status}: {body[:400]}\nKiểm tra NVIDIA_API_KEY và model.",
+                    reference=message
+                )
+            else:
+                logger.error("HTTPError %s: %s", api_err.status, body)
+                await message.channel.send(
+                    f"API trả về lỗi {api_err.status}, kiểm tra NVIDIA_API_KEY!",
+                    reference=message
+                )
+        except asyncio.TimeoutError:
+            logger.error("NVIDIA API timeout for user %s", user_id)
             await message.channel.send(
-                f"API trả về lỗi {status}, kiểm tra NVIDIA_API_KEY!",
+                "API NVIDIA phản hồi quá lâu, thử lại sau nha~",
                 reference=message
             )
         except Exception:
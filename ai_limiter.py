@@ -0,0 +1,132 @@
+"""
+AI Limiter - Admission control cho các lệnh gọi LLM
+Giới hạn số request đồng thời, mỗi user chỉ 1 request một lúc, và token bucket theo quota NVIDIA
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# NVIDIA free tier cho ~40 request/phút
+NVIDIA_MAX_CONCURRENCY = int(os.getenv("NVIDIA_MAX_CONCURRENCY", "4"))
+NVIDIA_RPM = float(os.getenv("NVIDIA_RPM", "40"))
+NVIDIA_BURST = 5
+MAX_QUEUE_DEPTH = 50
+
+
+class AdmissionRejected(Exception):
+    """The wait queue is full; the caller should tell the user to retry later"""
+
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`; waiters reserve tokens in order"""
+
+    def __init__(self, rate_per_minute: float, capacity: int):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # Reserve the token now (may go negative) so later callers queue behind us
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class AdmissionController:
+    """Global in-flight cap + per-user single flight + rate limit, with metrics"""
+
+    def __init__(
+        self,
+        max_in_flight: int = NVIDIA_MAX_CONCURRENCY,
+        requests_per_minute: float = NVIDIA_RPM,
+        burst: int = NVIDIA_BURST,
+        max_queue: int = MAX_QUEUE_DEPTH,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._bucket = TokenBucket(requests_per_minute, burst)
+        self._user_locks: Dict[str, asyncio.Lock] = {}
+        self._user_refs: Dict[str, int] = {}
+
+        # Metrics
+        self.queued = 0
+        self.peak_queued = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waits: Deque[float] = deque(maxlen=500)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        """Wait for permission to call the LLM; yields the time spent waiting (seconds)"""
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected()
+
+        started = time.monotonic()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        self._user_refs[user_id] = self._user_refs.get(user_id, 0) + 1
+        admitted = False
+
+        try:
+            # One request per user at a time: rapid messages queue instead of racing
+            async with lock:
+                async with self._semaphore:
+                    await self._bucket.acquire()
+                    waited = time.monotonic() - started
+                    self._waits.append(waited)
+                    self.queued -= 1
+                    self.in_flight += 1
+                    self.admitted += 1
+                    admitted = True
+                    try:
+                        yield waited
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            if not admitted:
+                self.queued -= 1
+            self._user_refs[user_id] -= 1
+            if not self._user_refs[user_id]:
+                del self._user_refs[user_id]
+                self._user_locks.pop(user_id, None)
+
+    def stats(self) -> Dict:
+        waits = sorted(self._waits)
+        if waits:
+            avg = sum(waits) / len(waits)
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            worst = waits[-1]
+        else:
+            avg = p95 = worst = 0.0
+        return {
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg_ms": avg * 1000,
+            "wait_p95_ms": p95 * 1000,
+            "wait_max_ms": worst * 1000,
+        }
+
+
+# Global instance
+admission = AdmissionController()
@@ -1,27 +1,15 @@
-import os
-import json
-from typing import Dict, List, Set
+from typing import List, Set
 
-DISABLE_FILE = "disabled_commands.json"
+from storage import StorageTable
 
 class CommandDisableSystem:
     def __init__(self):
-        self.data = self.load_data()
+        self.table = StorageTable("disabled_commands")
+        self.data = self.table.rows
     
-    def load_data(self) -> Dict:
-        """Load disabled commands data from file"""
-        if os.path.exists(DISABLE_FILE):
-            try:
-                with open(DISABLE_FILE, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-        return {}
-    
-    def save_data(self):
-        """Save disabled commands data to file"""
-        with open(DISABLE_FILE, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+    def save_data(self, channel_id: str):
+        """Schedule a write-behind save of one channel's disabled commands"""
+        self.table.mark_dirty(channel_id)
     
     def disable_command(self, channel_id: str, command: str):
         """Disable a command in a specific channel"""
@@ -30,7 +18,7 @@ class CommandDisableSystem:
         
         if command not in self.data[channel_id]:
             self.data[channel_id].append(command)
-            self.save_data()
+            self.save_data(channel_id)
             return True
         return False
     
@@ -40,7 +28,7 @@ class CommandDisableSystem:
             self.data[channel_id].remove(command)
             if not self.data[channel_id]:
                 del self.data[channel_id]
-            self.save_data()
+            self.save_data(channel_id)
             return True
         return False
     
@@ -56,7 +44,7 @@ class CommandDisableSystem:
         """Clear all disabled commands in a channel"""
         if channel_id in self.data:
             del self.data[channel_id]
-            self.save_data()
+            self.save_data(channel_id)
             return True
         return False
     
@@ -0,0 +1,187 @@
+"""
+Conversation Cache - Giữ lịch sử chat AI trong RAM thay vì đọc/ghi file mỗi tin nhắn
+LRU theo user, mỗi user là một ring buffer 20 tin, ghi file lười (khi bị evict hoặc flush định kỳ)
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List
+
+from storage import WriteBehindFlusher, atomic_write_text
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = "user_histories"
+
+
+class ConversationCache:
+    """Bounded LRU of per-user conversation ring buffers backed by JSON files"""
+
+    def __init__(
+        self,
+        history_dir: str = HISTORY_DIR,
+        max_turns: int = 20,
+        max_users: int = 1000,
+        max_chars: int = 4_000_000,
+        flush_interval_ms: int = 10_000,
+    ):
+        self.history_dir = history_dir
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.max_chars = max_chars
+
+        self._entries: "OrderedDict[str, Deque[Dict]]" = OrderedDict()
+        self._chars: Dict[str, int] = {}
+        self._total_chars = 0
+        self._dirty = set()
+        # Evicted dirty histories waiting for the flusher thread (never written on the caller's thread)
+        self._pending_writes: Dict[str, List[Dict]] = {}
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.flusher = WriteBehindFlusher(
+            self._flush_dirty,
+            interval_ms=flush_interval_ms,
+            max_pending=500,
+            name="history-flusher",
+        )
+
+    def path_for(self, user_id: str) -> str:
+        return os.path.join(self.history_dir, f"{user_id}.json")
+
+    def _load_file(self, user_id: str) -> List[Dict]:
+        path = self.path_for(user_id)
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                history = json.load(f)
+        except json.JSONDecodeError:
+            return []
+        # Filter out empty messages
+        return [
+            msg for msg in history
+            if isinstance(msg, dict) and msg.get("content") and str(msg.get("content")).strip()
+        ]
+
+    def _write_file(self, user_id: str, entries: List[Dict]):
+        os.makedirs(self.history_dir, exist_ok=True)
+        atomic_write_text(self.path_for(user_id), json.dumps(entries, ensure_ascii=False))
+
+    def _get_locked(self, user_id: str) -> Deque[Dict]:
+        entries = self._entries.get(user_id)
+        if entries is not None:
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            return entries
+
+        self.misses += 1
+        pending = self._pending_writes.pop(user_id, None)
+        if pending is not None:
+            # Evicted but not written yet: the in-memory copy is newer than the file
+            entries = deque(pending, maxlen=self.max_turns)
+            self._dirty.add(user_id)
+        else:
+            entries = deque(self._load_file(user_id), maxlen=self.max_turns)
+        self._entries[user_id] = entries
+        self._recount(user_id)
+        return entries
+
+    def _recount(self, user_id: str):
+        size = sum(len(str(msg.get("content", ""))) for msg in self._entries[user_id])
+        self._total_chars += size - self._chars.get(user_id, 0)
+        self._chars[user_id] = size
+
+    def history(self, user_id: str) -> List[Dict]:
+        """Return a copy of the user's recent messages (oldest first)"""
+        with self._lock:
+            entries = list(self._get_locked(user_id))
+        self._evict()
+        return entries
+
+    def append(self, user_id: str, role: str, content: str):
+        """Add one message; the file is written later by the flusher"""
+        with self._lock:
+            self._get_locked(user_id).append({"role": role, "content": content})
+            self._recount(user_id)
+            self._dirty.add(user_id)
+        self.flusher.mark_dirty()
+        self._evict()
+
+    def clear(self, user_id: str) -> bool:
+        """Forget a user's history in memory and on disk"""
+        with self._io_lock:
+            with self._lock:
+                had_entries = bool(self._entries.pop(user_id, None))
+                had_entries |= self._pending_writes.pop(user_id, None) is not None
+                self._total_chars -= self._chars.pop(user_id, 0)
+                self._dirty.discard(user_id)
+            path = self.path_for(user_id)
+            if os.path.exists(path):
+                os.remove(path)
+                return True
+        return had_entries
+
+    def _evict(self):
+        """Drop least recently used users until both caps are respected.
+
+        Runs on the caller's (event loop) thread, so dirty histories are only
+        handed to the flusher here, never written directly.
+        """
+        evicted = False
+        with self._lock:
+            while self._entries and (
+                len(self._entries) > self.max_users or self._total_chars > self.max_chars
+            ):
+                user_id, entries = self._entries.popitem(last=False)
+                self._total_chars -= self._chars.pop(user_id, 0)
+                self.evictions += 1
+                if user_id in self._dirty:
+                    self._dirty.discard(user_id)
+                    self._pending_writes[user_id] = list(entries)
+                    evicted = True
+
+        if evicted:
+            self.flusher.mark_dirty()
+
+    def _flush_dirty(self):
+        with self._io_lock:
+            with self._lock:
+                snapshot = self._pending_writes
+                self._pending_writes = {}
+                snapshot.update({
+                    user_id: list(self._entries[user_id])
+                    for user_id in self._dirty
+                    if user_id in self._entries
+                })
+                self._dirty.clear()
+            for user_id, entries in snapshot.items():
+                self._write_file(user_id, entries)
+
+    def flush(self):
+        """Write every dirty history to disk now"""
+        self.flusher.flush()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "chars": self._total_chars,
+            "dirty": len(self._dirty) + len(self._pending_writes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups * 100) if lookups else 0.0,
+        }
+
+
+# Global instance
+conversation_cache = ConversationCache()
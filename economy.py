@@ -1,31 +1,30 @@
-import os
-import json
 import random
 from datetime import datetime, timedelta
 from typing import Dict, Optional
 
-# File lưu trữ economy data
-ECONOMY_FILE = "economy_data.json"
+from storage import StorageTable
+
+# Write-behind: gom thay đổi, ghi tối đa mỗi 500ms hoặc sau 200 thay đổi
+ECONOMY_FLUSH_INTERVAL_MS = 500
+ECONOMY_FLUSH_MAX_PENDING = 200
 
 class EconomySystem:
     def __init__(self):
-        self.data = self.load_data()
+        self.table = StorageTable(
+            "economy",
+            interval_ms=ECONOMY_FLUSH_INTERVAL_MS,
+            max_pending=ECONOMY_FLUSH_MAX_PENDING,
+        )
+        self.data = self.table.rows
         self.owner_ids = []  # Will be set from lenh.py
     
-    def load_data(self) -> Dict:
-        """Load economy data from file"""
-        if os.path.exists(ECONOMY_FILE):
-            try:
-                with open(ECONOMY_FILE, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-        return {}
+    def mark_dirty(self, user_id: str):
+        """Schedule a write-behind save of one user's row"""
+        self.table.mark_dirty(user_id)
     
-    def save_data(self):
-        """Save economy data to file"""
-        with open(ECONOMY_FILE, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+    def flush(self):
+        """Write pending changes immediately (used on shutdown)"""
+        self.table.flush()
     
     def get_user(self, user_id: str) -> Dict:
         """Get user data, create if not exists"""
@@ -45,7 +44,7 @@ class EconomySystem:
                 "losses": 0,
                 "created_at": datetime.now().isoformat()
             }
-            self.save_data()
+            self.mark_dirty(user_id)
         
         # Migrate old data - add missing fields
         user = self.data[user_id]
@@ -72,7 +71,7 @@ class EconomySystem:
             updated = True
         
         if updated:
-            self.save_data()
+            self.mark_dirty(user_id)
         
         return user
     
@@ -85,7 +84,7 @@ class EconomySystem:
         """Set infinity mode for user (owner only)"""
         user = self.get_user(user_id)
         user["infinity"] = enabled
-        self.save_data()
+        self.mark_dirty(user_id)
     
     def get_balance(self, user_id: str) -> int:
         """Get user's wallet balance"""
@@ -107,7 +106,7 @@ class EconomySystem:
         else:
             user["balance"] += amount
         user["total_earned"] += amount
-        self.save_data()
+        self.mark_dirty(user_id)
     
     def remove_money(self, user_id: str, amount: int, from_bank: bool = False) -> bool:
         """Remove money from user's wallet or bank"""
@@ -120,13 +119,13 @@ class EconomySystem:
             if user["bank"] >= amount:
                 user["bank"] -= amount
                 user["total_spent"] += amount
-                self.save_data()
+                self.mark_dirty(user_id)
                 return True
         else:
             if user["balance"] >= amount:
                 user["balance"] -= amount
                 user["total_spent"] += amount
-                self.save_data()
+                self.mark_dirty(user_id)
                 return True
         return False
     
@@ -155,7 +154,7 @@ class EconomySystem:
         user = self.get_user(user_id)
         user["level"] = level
         user["xp"] = 0  # Reset XP when setting level
-        self.save_data()
+        self.mark_dirty(user_id)
     
     def get_xp_for_level(self, level: int) -> int:
         """Calculate XP needed for a level"""
@@ -172,10 +171,10 @@ class EconomySystem:
         if user["xp"] >= xp_needed:
             user["xp"] -= xp_needed
             user["level"] = current_level + 1
-            self.save_data()
+            self.mark_dirty(user_id)
             return user["level"]
         
-        self.save_data()
+        self.mark_dirty(user_id)
         return None
     
     def claim_daily(self, user_id: str) -> Dict:
@@ -230,7 +229,7 @@ class EconomySystem:
             user["level"] = current_level + 1
             new_level = user["level"]
         
-        self.save_data()
+        self.mark_dirty(user_id)
         
         return {
             "amount": amount,
@@ -246,13 +245,13 @@ class EconomySystem:
         """Record a win"""
         user = self.get_user(user_id)
         user["wins"] += 1
-        self.save_data()
+        self.mark_dirty(user_id)
     
     def record_loss(self, user_id: str):
         """Record a loss"""
         user = self.get_user(user_id)
         user["losses"] += 1
-        self.save_data()
+        self.mark_dirty(user_id)
     
     def get_stats(self, user_id: str) -> Dict:
         """Get user statistics"""
@@ -268,7 +267,7 @@ class EconomySystem:
         if user["balance"] >= amount:
             user["balance"] -= amount
             user["bank"] += amount
-            self.save_data()
+            self.mark_dirty(user_id)
             return True
         return False
     
@@ -282,7 +281,7 @@ class EconomySystem:
         if user["bank"] >= amount:
             user["bank"] -= amount
             user["balance"] += amount
-            self.save_data()
+            self.mark_dirty(user_id)
             return True
         return False
 
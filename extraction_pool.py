@@ -0,0 +1,109 @@
+"""
+Extraction Pool - Thread pool riêng cho yt-dlp, không tranh executor mặc định với phần còn lại của bot
+Các query giống nhau đang chạy cùng lúc dùng chung một future (single-flight), kèm metrics theo guild
+"""
+
+import asyncio
+import bisect
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+YTDL_WORKERS = int(os.getenv("YTDL_WORKERS", "4"))
+# Mốc histogram độ trễ (ms), bucket cuối là "lâu hơn nữa"
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 5000, 10000)
+
+
+@dataclass
+class GuildExtractionStats:
+    depth: int = 0
+    peak_depth: int = 0
+    completed: int = 0
+    failed: int = 0
+    coalesced: int = 0
+    histogram: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+
+    def observe(self, elapsed_ms: float):
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+
+class ExtractionPool:
+    """Bounded executor for blocking extractor calls with single-flight coalescing"""
+
+    def __init__(self, max_workers: int = YTDL_WORKERS):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ytdl")
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._guilds: Dict[Optional[int], GuildExtractionStats] = {}
+
+    def _stats_for(self, guild_id: Optional[int]) -> GuildExtractionStats:
+        stats = self._guilds.get(guild_id)
+        if stats is None:
+            stats = GuildExtractionStats()
+            self._guilds[guild_id] = stats
+        return stats
+
+    async def run(self, key: str, fn: Callable[[], Any], guild_id: Optional[int] = None) -> Any:
+        """Run `fn` on the pool, or join the identical call already in flight"""
+        stats = self._stats_for(guild_id)
+        future = self._inflight.get(key)
+        if future is not None:
+            stats.coalesced += 1
+            # shield: one caller giving up must not cancel the others
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, fn)
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        stats.depth += 1
+        stats.peak_depth = max(stats.peak_depth, stats.depth)
+        started = time.monotonic()
+        try:
+            result = await asyncio.shield(future)
+        except Exception:
+            stats.failed += 1
+            raise
+        else:
+            stats.completed += 1
+            return result
+        finally:
+            stats.depth -= 1
+            stats.observe((time.monotonic() - started) * 1000)
+
+    def stats(self, guild_id: Optional[int] = None) -> Dict:
+        """Totals across guilds, plus the given guild's own numbers"""
+        totals = GuildExtractionStats()
+        for stats in self._guilds.values():
+            totals.depth += stats.depth
+            totals.peak_depth = max(totals.peak_depth, stats.peak_depth)
+            totals.completed += stats.completed
+            totals.failed += stats.failed
+            totals.coalesced += stats.coalesced
+            totals.histogram = [a + b for a, b in zip(totals.histogram, stats.histogram)]
+        return {
+            "workers": self.max_workers,
+            "inflight": len(self._inflight),
+            "total": totals,
+            "guild": self._guilds.get(guild_id),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def format_histogram(histogram: List[int]) -> str:
+    """'≤250ms:3 ≤500ms:1 ... >10000ms:0' for stats embeds"""
+    labels = [f"≤{bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+    return " ".join(f"{label}:{count}" for label, count in zip(labels, histogram))
+
+
+# Global instance
+extraction_pool = ExtractionPool()
@@ -0,0 +1,20 @@
+"""
+HTTP Session - Tạo aiohttp session có connection pool (keep-alive, cache DNS)
+Dùng chung cho các client sống lâu của bot (NVIDIA API, avatar cho profile card)
+"""
+
+from typing import Optional
+
+import aiohttp
+
+
+def create_pooled_session(max_connections: int, timeout: Optional[float] = None) -> aiohttp.ClientSession:
+    """Keep-alive session capped at max_connections (needs a running event loop)"""
+    connector = aiohttp.TCPConnector(
+        limit=max_connections,
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+    )
+    if timeout is None:
+        return aiohttp.ClientSession(connector=connector)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
@@ -0,0 +1,59 @@
+"""
+Idempotency - Nhớ các Discord ID (snowflake) đã xử lý để không xử lý trùng
+OrderedDict có giới hạn: bỏ ID cũ nhất theo LRU và theo cửa sổ thời gian lấy từ chính snowflake
+"""
+
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Discord epoch (2015-01-01) tính bằng ms
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def snowflake_time_ms(snowflake: int) -> int:
+    """Creation time (unix ms) encoded in the top 42 bits of a Discord ID"""
+    return (snowflake >> 22) + DISCORD_EPOCH_MS
+
+
+class RecentIds:
+    """Bounded set of recently seen snowflakes with O(1) check-and-add.
+
+    IDs are roughly monotonic, so the oldest ones sit at the front of the
+    OrderedDict and pruning only ever pops from the left.
+    """
+
+    def __init__(self, max_size: int = 2000, window_seconds: Optional[float] = 600):
+        self.max_size = max_size
+        self.window_ms = window_seconds * 1000 if window_seconds else None
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+
+    def __contains__(self, snowflake: int) -> bool:
+        return snowflake in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, snowflake: int):
+        self._ids[snowflake] = None
+        self._prune()
+
+    def seen(self, snowflake: int) -> bool:
+        """Return True if the ID was already seen, otherwise remember it and return False"""
+        if snowflake in self._ids:
+            return True
+        self.add(snowflake)
+        return False
+
+    def _prune(self):
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+        if self.window_ms is None:
+            return
+        cutoff = time.time() * 1000 - self.window_ms
+        while self._ids:
+            oldest = next(iter(self._ids))
+            if snowflake_time_ms(oldest) >= cutoff:
+                break
+            self._ids.popitem(last=False)
@@ -0,0 +1,190 @@
+"""
+Indexed Queue - Hàng đợi nhạc có truy cập theo vị trí (implicit treap)
+insert/remove/move theo vị trí O(log n), lấy một trang O(log n + k), shuffle O(n)
+API giống deque ở những chỗ lenh.py dùng (append, appendleft, popleft, extend, clear, [0])
+"""
+
+import random
+import sys
+from typing import Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class _Node:
+    __slots__ = ("value", "priority", "size", "left", "right")
+
+    def __init__(self, value, priority: Optional[float] = None):
+        self.value = value
+        self.priority = random.random() if priority is None else priority
+        self.size = 1
+        self.left: Optional["_Node"] = None
+        self.right: Optional["_Node"] = None
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node else 0
+
+
+def _update(node: _Node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _split(node: Optional[_Node], count: int) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """Split into (first `count` items, the rest)"""
+    if node is None:
+        return None, None
+    if _size(node.left) >= count:
+        left, node.left = _split(node.left, count)
+        _update(node)
+        return left, node
+    node.right, right = _split(node.right, count - _size(node.left) - 1)
+    _update(node)
+    return node, right
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _build(items: Iterable) -> Optional[_Node]:
+    """Build a treap from items in O(n) (Cartesian tree over random priorities)"""
+    stack: List[_Node] = []
+    for value in items:
+        node = _Node(value)
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+            _update(last)
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    # Sizes along the right spine are only final once the whole list is in
+    for node in reversed(stack):
+        _update(node)
+    return stack[0] if stack else None
+
+
+def _iter_nodes(node: Optional[_Node]) -> Iterator[_Node]:
+    stack: List[_Node] = []
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node
+        node = node.right
+
+
+class IndexedQueue(Generic[T]):
+    """Sequence with O(log n) positional insert/remove/move and O(log n + k) slicing"""
+
+    def __init__(self, items: Iterable[T] = ()):
+        self._root = _build(items)
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __bool__(self) -> bool:
+        return self._root is not None
+
+    def __iter__(self) -> Iterator[T]:
+        for node in _iter_nodes(self._root):
+            yield node.value
+
+    def __sizeof__(self) -> int:
+        node_size = sys.getsizeof(_Node.__new__(_Node))
+        return object.__sizeof__(self) + len(self) * node_size
+
+    def __repr__(self) -> str:
+        return f"IndexedQueue({list(self)!r})"
+
+    def _index(self, index: int) -> int:
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("IndexedQueue index out of range")
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.page(0, len(self))[index]
+            return self.page(start, stop)
+        index = self._index(index)
+        node = self._root
+        while node:
+            left = _size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.value
+            else:
+                index -= left + 1
+                node = node.right
+        raise IndexError("IndexedQueue index out of range")
+
+    def page(self, start: int, stop: int) -> List[T]:
+        """Items in [start, stop) without walking the rest of the queue"""
+        start = max(0, start)
+        stop = min(len(self), stop)
+        if start >= stop:
+            return []
+        left, rest = _split(self._root, start)
+        middle, right = _split(rest, stop - start)
+        values = [node.value for node in _iter_nodes(middle)]
+        self._root = _merge(left, _merge(middle, right))
+        return values
+
+    def append(self, value: T):
+        self._root = _merge(self._root, _Node(value))
+
+    def appendleft(self, value: T):
+        self._root = _merge(_Node(value), self._root)
+
+    def extend(self, values: Iterable[T]):
+        self._root = _merge(self._root, _build(values))
+
+    def insert(self, index: int, value: T):
+        index = max(0, min(index if index >= 0 else index + len(self), len(self)))
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, _Node(value)), right)
+
+    def pop(self, index: int = -1) -> T:
+        index = self._index(index)
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._root = _merge(left, right)
+        return node.value
+
+    def popleft(self) -> T:
+        if self._root is None:
+            raise IndexError("pop from an empty IndexedQueue")
+        return self.pop(0)
+
+    def move(self, src: int, dst: int) -> T:
+        """Move the item at `src` so it ends up at position `dst`"""
+        value = self.pop(src)
+        self.insert(dst, value)
+        return value
+
+    def clear(self):
+        self._root = None
+
+    def shuffle(self):
+        values = list(self)
+        random.shuffle(values)
+        self._root = _build(values)
@@ -3,11 +3,13 @@ import logging
 import os
 import re
 import shutil
+import sys
+import time
 import urllib.parse
 from collections import deque
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
 from datetime import datetime, timedelta
-from typing import Deque, Dict, Optional
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
 
 import discord
 from discord.ext import commands
@@ -18,10 +20,14 @@ import ai
 from economy import economy
 from afk_system import afk_system
 from command_disable import disable_system
-from profile_card import profile_card_generator
+from profile_card import profile_card_generator, CardQueueFull, CARD_ENCODERS, CARD_FORMAT
 from interactions import interaction_system
 from shop_system import shop_system
 from marriage_system import marriage_system
+from storage import StorageTable
+from track_cache import normalize_query, track_cache
+from indexed_queue import IndexedQueue
+from extraction_pool import extraction_pool, format_histogram
 
 
 OWNER_IDS = [int(x) for x in os.getenv("BOT_OWNER_IDS", "").split(",") if x.strip().isdigit()]
@@ -38,9 +44,32 @@ FFMPEG_OPTIONS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
     "options": "-vn",
 }
+# FFmpeg xuất thẳng Opus: nguồn Opus thì copy nguyên, còn lại encode bằng libopus trong FFmpeg
+OPUS_BITRATE = 128
 
 ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
 
+# Playlist/set: chỉ lấy metadata phẳng, stream URL được resolve sát giờ phát
+MAX_PLAYLIST_TRACKS = 100
+PLAYLIST_RESOLVE_AHEAD = 3
+# Only real playlists/sets: a watch?v=X&list=RD... link (shared from a mix) is still one song
+PLAYLIST_URL_PATTERN = re.compile(r"soundcloud\.com/[^/?#]+/sets/[^/?#]+|/playlist\?(?:[^#]*&)?list=")
+PLAYLIST_YTDL_OPTIONS = dict(
+    YTDL_OPTIONS,
+    noplaylist=False,
+    extract_flat="in_playlist",
+    playlistend=MAX_PLAYLIST_TRACKS,
+)
+playlist_ytdl = yt_dlp.YoutubeDL(PLAYLIST_YTDL_OPTIONS)
+
+
+def is_playlist_url(query: str) -> bool:
+    if not PLAYLIST_URL_PATTERN.search(query):
+        return False
+    # playlist?list=...&v=... still points at a single video
+    return "v" not in urllib.parse.parse_qs(urllib.parse.urlparse(query.strip()).query)
+
+
 _FFMPEG_EXEC: Optional[str] = None
 _FFMPEG_HINTS = [
     r"C:\\ffmpeg\\bin\\ffmpeg.exe",
@@ -78,16 +107,81 @@ def resolve_ffmpeg_path() -> Optional[str]:
     return None
 
 
-@dataclass
+# Stream URL của SoundCloud/YouTube là link ký tên, hết hạn sau một lúc
+STREAM_URL_MAX_AGE = 15 * 60
+STREAM_REFRESH_MARGIN = 60
+# Chuẩn bị bài kế tiếp trước khi bài hiện tại hết bao nhiêu giây
+PREFETCH_LEAD_SECONDS = 15
+PREPARED_SOURCE_MAX_AGE = 60
+
+
+def stream_expires_at(url: str) -> Optional[float]:
+    """Unix time a signed stream URL stops working, if the URL says so"""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    for key in ("Expires", "expires", "expire"):
+        values = query.get(key)
+        if values and values[0].isdigit():
+            return float(values[0])
+    return None
+
+
+@dataclass(slots=True)
 class MusicTrack:
     title: str
     stream_url: str
     webpage_url: str
+    duration: Optional[float] = None
+    resolved_at: float = field(default_factory=time.time)
+    track_id: Optional[str] = None
+    codec: Optional[str] = None
+
+    def expires_at(self) -> float:
+        return stream_expires_at(self.stream_url) or self.resolved_at + STREAM_URL_MAX_AGE
+
+    def needs_refresh(self, margin: float = STREAM_REFRESH_MARGIN) -> bool:
+        # Bài từ playlist chưa có stream URL cho tới khi sắp phát
+        if not self.stream_url:
+            return True
+        return time.time() + margin >= self.expires_at()
+
+
+class HistoryEntry(NamedTuple):
+    """Compact play-history record (no signed stream URL, which is long and expires anyway)"""
+    title: str
+    webpage_url: str
+    duration: Optional[float] = None
 
+    @classmethod
+    def from_track(cls, track: MusicTrack) -> "HistoryEntry":
+        return cls(track.title, track.webpage_url, track.duration)
 
-@dataclass
+    def to_track(self) -> MusicTrack:
+        # Stream URL được resolve lại lúc phát
+        return MusicTrack(title=self.title, stream_url="", webpage_url=self.webpage_url, duration=self.duration)
+
+
+# State của guild không dùng nhạc quá lâu sẽ bị bỏ khỏi RAM (lịch sử được lưu lại)
+MUSIC_STATE_IDLE_SECONDS = 30 * 60
+MUSIC_SWEEP_INTERVAL = 5 * 60
+MUSIC_HISTORY_SIZE = 50
+# Gom nhiều thay đổi hàng đợi thành một lần ghi
+QUEUE_SNAPSHOT_DELAY = 5
+QUEUE_PAGE_SIZE = 15
+
+
+def _footprint(obj) -> int:
+    """Shallow size plus the strings a track/history record holds"""
+    size = sys.getsizeof(obj)
+    for attr in ("title", "stream_url", "webpage_url"):
+        value = getattr(obj, attr, None)
+        if isinstance(value, str):
+            size += sys.getsizeof(value)
+    return size
+
+
+@dataclass(slots=True)
 class MusicState:
-    queue: Deque[MusicTrack] = field(default_factory=deque)
+    queue: IndexedQueue[MusicTrack] = field(default_factory=IndexedQueue)
     voice_client: Optional[discord.VoiceClient] = None
     now_playing: Optional[MusicTrack] = None
     stay_mode: bool = False
@@ -95,7 +189,54 @@ class MusicState:
     auto_leave_task: Optional[asyncio.Task] = None
     loop_mode: str = "off"  # "off", "one", "all"
     volume: float = 1.0
-    play_history: Deque[MusicTrack] = field(default_factory=lambda: deque(maxlen=50))
+    play_history: Deque[HistoryEntry] = field(default_factory=lambda: deque(maxlen=MUSIC_HISTORY_SIZE))
+    prefetch_task: Optional[asyncio.Task] = None
+    prepared_track: Optional[MusicTrack] = None
+    prepared_source: Optional[discord.AudioSource] = None
+    prepared_at: float = 0.0
+    resolve_tasks: Set[asyncio.Task] = field(default_factory=set)
+    last_active: float = field(default_factory=time.monotonic)
+    # Vị trí phát để restart FFmpeg đúng chỗ khi đổi âm lượng
+    play_started_at: float = 0.0
+    seek_offset: float = 0.0
+    paused_at: Optional[float] = None
+
+    def position(self) -> float:
+        """Seconds into the current track"""
+        now = self.paused_at or time.monotonic()
+        return self.seek_offset + max(0.0, now - self.play_started_at)
+
+    def mark_started(self, offset: float = 0.0) -> None:
+        self.play_started_at = time.monotonic()
+        self.seek_offset = offset
+        self.paused_at = None
+
+    def is_idle(self) -> bool:
+        """Nothing playing, queued, connected or pending"""
+        connected = self.voice_client is not None and self.voice_client.is_connected()
+        busy_tasks = any(
+            task and not task.done()
+            for task in (self.auto_leave_task, self.prefetch_task, *self.resolve_tasks)
+        )
+        return not (connected or self.queue or self.now_playing or self.stay_mode or busy_tasks)
+
+    def footprint(self) -> int:
+        """Approximate bytes held by this state (tracks, history, containers)"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.queue) + sys.getsizeof(self.play_history)
+        size += sum(_footprint(track) for track in self.queue)
+        size += sum(_footprint(entry) for entry in self.play_history)
+        if self.now_playing:
+            size += _footprint(self.now_playing)
+        return size
+
+
+# Gọi lúc bot tắt để lưu hàng đợi nhạc (main.py)
+_shutdown_hooks: List[Callable[[], None]] = []
+
+
+def save_music_state() -> None:
+    for hook in _shutdown_hooks:
+        hook()
 
 
 def setup(bot_instance: commands.Bot) -> None:
@@ -124,14 +265,159 @@ def setup(bot_instance: commands.Bot) -> None:
         return True
 
     music_states: Dict[int, MusicState] = {}
+    # Lịch sử phát của guild đã bị evict: guild_id -> [[title, url, duration], ...]
+    music_history_table = StorageTable("music_history", interval_ms=5000)
+    # Hàng đợi đã lưu: guild_id -> {"tracks": [[title, url, duration], ...], "loop", "volume", ...}
+    music_queue_table = StorageTable("music_queues", interval_ms=2000)
+    music_sweeper_task: Optional[asyncio.Task] = None
+    music_evictions = 0
+    snapshot_dirty: Set[int] = set()
+    snapshot_task: Optional[asyncio.Task] = None
+    music_restored = False
+
+    def load_history(guild_id: int) -> Deque[HistoryEntry]:
+        rows = music_history_table.rows.get(str(guild_id)) or []
+        return deque((HistoryEntry(*row) for row in rows), maxlen=MUSIC_HISTORY_SIZE)
+
+    def restore_saved_queue(state: MusicState, guild_id: int) -> None:
+        """Load a snapshotted queue; tracks come back unresolved and resolve when played"""
+        row = music_queue_table.rows.get(str(guild_id))
+        if not row:
+            return
+        state.queue = IndexedQueue(HistoryEntry(*entry).to_track() for entry in row.get("tracks") or [])
+        state.loop_mode = row.get("loop", state.loop_mode)
+        state.volume = row.get("volume", state.volume)
+        state.stay_mode = row.get("stay", state.stay_mode)
 
     def get_state(guild_id: int) -> MusicState:
         state = music_states.get(guild_id)
         if state is None:
-            state = MusicState()
+            state = MusicState(play_history=load_history(guild_id))
+            restore_saved_queue(state, guild_id)
             music_states[guild_id] = state
+            ensure_music_sweeper()
+        state.last_active = time.monotonic()
+        return state
+
+    def find_state(guild_id: int) -> Optional[MusicState]:
+        """Like music_states.get, but restores a snapshotted queue on first touch"""
+        state = music_states.get(guild_id)
+        if state is None and str(guild_id) in music_queue_table.rows:
+            state = get_state(guild_id)
         return state
 
+    def snapshot_row(state: MusicState) -> Optional[Dict]:
+        tracks = ([state.now_playing] if state.now_playing else []) + list(state.queue)
+        if not tracks:
+            return None
+        voice_client = state.voice_client
+        connected = voice_client is not None and voice_client.is_connected()
+        return {
+            # Chỉ lưu link trang của bài, stream URL sẽ resolve lại
+            "tracks": [list(HistoryEntry.from_track(track)) for track in tracks],
+            "loop": state.loop_mode,
+            "volume": state.volume,
+            "stay": state.stay_mode,
+            "playing": connected and state.now_playing is not None,
+            "voice_channel": voice_client.channel.id if connected else None,
+            "text_channel": getattr(state.text_channel, "id", None),
+        }
+
+    def write_snapshots(guild_ids) -> None:
+        for guild_id in guild_ids:
+            state = music_states.get(guild_id)
+            if state is None:
+                continue
+            key = str(guild_id)
+            row = snapshot_row(state)
+            if row is None:
+                music_queue_table.rows.pop(key, None)
+            else:
+                music_queue_table.rows[key] = row
+            music_queue_table.mark_dirty(key)
+
+    def schedule_queue_snapshot(guild_id: int) -> None:
+        """Mark a guild's queue as changed; snapshots are written a few seconds later in one go"""
+        nonlocal snapshot_task
+        snapshot_dirty.add(guild_id)
+        if snapshot_task and not snapshot_task.done():
+            return
+
+        async def _snapshot() -> None:
+            await asyncio.sleep(QUEUE_SNAPSHOT_DELAY)
+            dirty = list(snapshot_dirty)
+            snapshot_dirty.clear()
+            write_snapshots(dirty)
+
+        snapshot_task = bot.loop.create_task(_snapshot())
+
+    def save_all_queues() -> None:
+        snapshot_dirty.clear()
+        write_snapshots(list(music_states))
+        music_queue_table.flush()
+
+    _shutdown_hooks.append(save_all_queues)
+
+    @bot.listen("on_ready")
+    async def restore_playing_guilds() -> None:
+        """After a restart, rejoin voice only in guilds that were playing; the rest restore lazily"""
+        nonlocal music_restored
+        if music_restored:
+            return
+        music_restored = True
+
+        for key, row in list(music_queue_table.rows.items()):
+            if not row.get("playing") or not key.isdigit():
+                continue
+            guild = bot.get_guild(int(key))
+            channel = guild.get_channel(row.get("voice_channel") or 0) if guild else None
+            if not isinstance(channel, discord.VoiceChannel):
+                continue
+            try:
+                voice_client = guild.voice_client or await channel.connect()
+            except (discord.HTTPException, asyncio.TimeoutError, discord.ClientException) as exc:
+                logging.warning("Không vào lại voice ở guild %s: %s", key, exc)
+                continue
+
+            state = get_state(guild.id)
+            state.voice_client = voice_client
+            text_channel = guild.get_channel(row.get("text_channel") or 0)
+            if isinstance(text_channel, discord.abc.Messageable):
+                state.text_channel = text_channel
+            if not voice_client.is_playing():
+                await play_next(guild.id)
+
+    def evict_idle_states() -> int:
+        """Drop idle, disconnected states; their history goes to storage"""
+        nonlocal music_evictions
+        now = time.monotonic()
+        evicted = 0
+        for guild_id, state in list(music_states.items()):
+            if now - state.last_active < MUSIC_STATE_IDLE_SECONDS or not state.is_idle():
+                continue
+            key = str(guild_id)
+            if state.play_history:
+                music_history_table.rows[key] = [list(entry) for entry in state.play_history]
+                music_history_table.mark_dirty(key)
+            del music_states[guild_id]
+            evicted += 1
+        music_evictions += evicted
+        return evicted
+
+    def ensure_music_sweeper() -> None:
+        nonlocal music_sweeper_task
+        if music_sweeper_task and not music_sweeper_task.done():
+            return
+
+        async def _sweep() -> None:
+            while True:
+                await asyncio.sleep(MUSIC_SWEEP_INTERVAL)
+                evicted = evict_idle_states()
+                if evicted:
+                    logging.info("Đã evict %s music state rảnh", evicted)
+
+        music_sweeper_task = bot.loop.create_task(_sweep())
+
     def cancel_auto_leave(state: MusicState) -> None:
         if state.auto_leave_task and not state.auto_leave_task.done():
             state.auto_leave_task.cancel()
@@ -172,6 +458,7 @@ def setup(bot_instance: commands.Bot) -> None:
             else:
                 state_after.voice_client = None
                 state_after.now_playing = None
+                cancel_prefetch(state_after)
                 if state_after.text_channel:
                     await state_after.text_channel.send("không thấy ai gọi nên tớ out ròi nhé do!")
             state_after.auto_leave_task = None
@@ -208,7 +495,29 @@ def setup(bot_instance: commands.Bot) -> None:
         cancel_auto_leave(state)
         return voice_client
 
-    async def extract_track(query: str) -> MusicTrack:
+    async def extract_track(query: str, fresh: bool = False, guild_id: Optional[int] = None) -> MusicTrack:
+        """Resolve a query through the extraction cache; `fresh` skips cached stream URLs"""
+        resolve_query = query
+        if not fresh:
+            cached, valid = track_cache.lookup(query)
+            if cached:
+                track = MusicTrack(**cached)
+                if valid:
+                    return track
+                # Đã biết bài nào rồi, chỉ cần lấy lại stream từ trang của bài thay vì dò candidate
+                resolve_query = track.webpage_url
+
+        track = await resolve_track(resolve_query, guild_id)
+        track_cache.put(
+            query,
+            track.track_id or track.webpage_url,
+            asdict(track),
+            track.expires_at(),
+            track.webpage_url,
+        )
+        return track
+
+    async def resolve_track(query: str, guild_id: Optional[int] = None) -> MusicTrack:
         raw_query = query.strip()
         if not raw_query:
             raise ValueError("Thiếu từ khóa tìm nhạc.")
@@ -249,8 +558,6 @@ def setup(bot_instance: commands.Bot) -> None:
 
         logging.debug("SoundCloud candidates for '%s': %s", raw_query, candidates)
 
-        loop = asyncio.get_event_loop()
-
         def _parse_id_from_error(error: Exception) -> Optional[str]:
             message = str(getattr(error, "msg", None) or error)
             match = re.search(r"soundcloud%3Atracks%3A(\d+)", message)
@@ -334,11 +641,13 @@ def setup(bot_instance: commands.Bot) -> None:
             raise ValueError("Không tìm thấy kết quả SoundCloud nào hợp lệ.")
 
         try:
-            info = await loop.run_in_executor(None, _extract)
+            # Pool riêng cho yt-dlp; query giống nhau đang chạy thì đợi chung kết quả
+            info = await extraction_pool.run(normalize_query(search), _extract, guild_id)
         except (DownloadError, ExtractorError) as exc:
             raise ValueError(str(exc)) from exc
 
         stream_url: Optional[str] = info.get("url")
+        codec: Optional[str] = info.get("acodec")
 
         if not stream_url or stream_url.startswith("soundcloud:"):
             formats = info.get("formats") or []
@@ -362,13 +671,192 @@ def setup(bot_instance: commands.Bot) -> None:
 
             best = max(formats, key=sort_key)
             stream_url = best.get("url")
+            codec = best.get("acodec")
 
         if not stream_url or stream_url.startswith("soundcloud:"):
             raise ValueError("Không lấy được stream SoundCloud hợp lệ sau khi thử nhiều định dạng.")
 
         title = info.get("title", "SoundCloud track")
         webpage_url = info.get("webpage_url") or info.get("original_url") or search
-        return MusicTrack(title=title, stream_url=stream_url, webpage_url=webpage_url)
+        return MusicTrack(
+            title=title,
+            stream_url=stream_url,
+            webpage_url=webpage_url,
+            duration=info.get("duration"),
+            track_id=f"{info.get('extractor_key') or 'sc'}:{info['id']}" if info.get("id") else None,
+            codec=codec if codec and codec != "none" else None,
+        )
+
+    async def extract_playlist(query: str, guild_id: Optional[int] = None) -> Tuple[str, List[MusicTrack]]:
+        """Flat-extract a playlist/set into unresolved tracks (no stream URLs yet)"""
+        url = query.strip()
+
+        def _extract_flat():
+            return playlist_ytdl.extract_info(url, download=False)
+
+        try:
+            info = await extraction_pool.run(f"playlist:{url}", _extract_flat, guild_id)
+        except (DownloadError, ExtractorError) as exc:
+            raise ValueError(str(exc)) from exc
+
+        tracks = []
+        for entry in (info or {}).get("entries") or []:
+            if not entry:
+                continue
+            entry_url = entry.get("url") or entry.get("webpage_url")
+            if not entry_url:
+                continue
+            tracks.append(
+                MusicTrack(
+                    title=entry.get("title") or f"SoundCloud track {entry.get('id', '?')}",
+                    stream_url="",
+                    webpage_url=entry_url,
+                    duration=entry.get("duration"),
+                )
+            )
+        return (info or {}).get("title") or "playlist", tracks
+
+    async def refresh_track(track: MusicTrack, guild_id: Optional[int] = None) -> None:
+        """Resolve a lazy track, or re-resolve an expired (or soon to expire) stream URL, in place"""
+        # Bài chưa resolve lần nào thì vẫn được dùng cache
+        fresh = await extract_track(track.webpage_url, fresh=bool(track.stream_url), guild_id=guild_id)
+        track.title = fresh.title
+        track.stream_url = fresh.stream_url
+        track.webpage_url = fresh.webpage_url
+        track.duration = fresh.duration or track.duration
+        track.resolved_at = fresh.resolved_at
+        track.track_id = fresh.track_id or track.track_id
+        track.codec = fresh.codec
+
+    def schedule_resolve_ahead(guild_id: int) -> None:
+        """Resolve the next few unresolved tracks concurrently (window = concurrency bound)"""
+        state = music_states.get(guild_id)
+        if not state:
+            return
+
+        async def _resolve(track: MusicTrack) -> None:
+            try:
+                await refresh_track(track, guild_id)
+            except ValueError as exc:
+                # play_next sẽ thử lại lần nữa và bỏ qua bài nếu vẫn lỗi
+                logging.warning("Không resolve trước được %s: %s", track.webpage_url, exc)
+
+        for track in state.queue[:PLAYLIST_RESOLVE_AHEAD]:
+            if track.stream_url:
+                continue
+            task = bot.loop.create_task(_resolve(track))
+            state.resolve_tasks.add(task)
+            task.add_done_callback(state.resolve_tasks.discard)
+
+    def build_source(
+        track: MusicTrack, ffmpeg_exec: str, volume: float = 1.0, start_at: float = 0.0
+    ) -> discord.AudioSource:
+        """FFmpeg emits Opus packets directly, so discord.py does no PCM work per packet.
+
+        Opus sources at full volume are stream-copied; otherwise FFmpeg encodes
+        with libopus and applies the volume as a filter.
+        """
+        before_options = FFMPEG_OPTIONS["before_options"]
+        if start_at > 0:
+            before_options += f" -ss {start_at:.2f}"
+        options = FFMPEG_OPTIONS["options"]
+        codec = track.codec
+        if abs(volume - 1.0) > 1e-3:
+            options += f" -filter:a volume={volume:.2f}"
+            codec = None  # filter cần decode, không copy được
+        return discord.FFmpegOpusAudio(
+            track.stream_url,
+            bitrate=OPUS_BITRATE,
+            codec=codec,
+            executable=ffmpeg_exec,
+            before_options=before_options,
+            options=options,
+        )
+
+    def peek_next(state: MusicState) -> Optional[MusicTrack]:
+        """The track play_next will pick, without taking it off the queue"""
+        if state.loop_mode == "one" and state.now_playing:
+            return state.now_playing
+        if state.queue:
+            return state.queue[0]
+        return None
+
+    def discard_prepared(state: MusicState) -> None:
+        if state.prepared_source is not None:
+            state.prepared_source.cleanup()
+        state.prepared_track = None
+        state.prepared_source = None
+
+    def cancel_prefetch(state: MusicState) -> None:
+        if state.prefetch_task and not state.prefetch_task.done():
+            state.prefetch_task.cancel()
+        state.prefetch_task = None
+        for task in list(state.resolve_tasks):
+            task.cancel()
+        discard_prepared(state)
+
+    def take_prepared(state: MusicState, track: MusicTrack) -> Optional[discord.AudioSource]:
+        """Hand over the warmed FFmpeg source if it was built for this track and is still fresh"""
+        source = state.prepared_source
+        fresh = time.monotonic() - state.prepared_at < PREPARED_SOURCE_MAX_AGE
+        if source is not None and state.prepared_track is track and fresh and not track.needs_refresh(0):
+            state.prepared_track = None
+            state.prepared_source = None
+            return source
+        discard_prepared(state)
+        return None
+
+    def schedule_prefetch(guild_id: int) -> None:
+        state = music_states.get(guild_id)
+        if not state:
+            return
+        if state.prefetch_task and not state.prefetch_task.done():
+            state.prefetch_task.cancel()
+
+        async def _prefetch() -> None:
+            current = state.now_playing
+            try:
+                # Đợi tới gần cuối bài hiện tại để link bài sau còn hạn và FFmpeg không phải chờ lâu.
+                # Tính lại theo vị trí thật mỗi lần thức dậy, nên pause/resume không làm warm quá sớm
+                if current and current.duration:
+                    while True:
+                        if state.voice_client and state.voice_client.is_paused():
+                            await asyncio.sleep(PREFETCH_LEAD_SECONDS)
+                            continue
+                        wait = current.duration - state.position() - PREFETCH_LEAD_SECONDS
+                        if wait <= 0:
+                            break
+                        await asyncio.sleep(wait)
+
+                track = peek_next(state)
+                if not track or track is state.prepared_track:
+                    return
+                if track.needs_refresh():
+                    await refresh_track(track, guild_id)
+
+                ffmpeg_exec = resolve_ffmpeg_path()
+                # Chỉ warm FFmpeg khi biết bài hiện tại sắp hết, tránh giữ process chờ cả bài
+                if not ffmpeg_exec or not (current and current.duration) or peek_next(state) is not track:
+                    return
+                discard_prepared(state)
+                state.prepared_source = build_source(track, ffmpeg_exec, state.volume)
+                state.prepared_track = track
+                state.prepared_at = time.monotonic()
+            except asyncio.CancelledError:
+                return
+            except ValueError as exc:
+                logging.warning("Không prefetch được bài kế tiếp tại guild %s: %s", guild_id, exc)
+
+        state.prefetch_task = bot.loop.create_task(_prefetch())
+
+    def queue_reordered(guild_id: int, state: MusicState, previous_next: Optional[MusicTrack]) -> None:
+        """After +move/+remove/+shuffle: drop the FFmpeg warmed for the old next track, prefetch the new one"""
+        schedule_queue_snapshot(guild_id)
+        if peek_next(state) is previous_next:
+            return
+        discard_prepared(state)
+        if state.now_playing:
+            schedule_prefetch(guild_id)
 
     async def play_next(guild_id: int) -> None:
         state = music_states.get(guild_id)
@@ -384,21 +872,20 @@ def setup(bot_instance: commands.Bot) -> None:
         elif not state.queue:
             if state.loop_mode == "all" and state.play_history:
                 # Reload queue from history
-                state.queue = deque(state.play_history)
+                state.queue = IndexedQueue(entry.to_track() for entry in state.play_history)
                 track = state.queue.popleft()
             else:
                 state.now_playing = None
+                cancel_prefetch(state)
+                schedule_queue_snapshot(guild_id)
                 if not state.stay_mode and voice_client.is_connected():
                     schedule_auto_leave(guild_id)
                 return
         else:
             track = state.queue.popleft()
 
-        # Add to history if not looping one song
-        if state.loop_mode != "one":
-            state.play_history.append(track)
-        
         state.now_playing = track
+        state.last_active = time.monotonic()
 
         ffmpeg_exec = resolve_ffmpeg_path()
         if not ffmpeg_exec:
@@ -413,17 +900,41 @@ def setup(bot_instance: commands.Bot) -> None:
         def after_play(error: Optional[Exception]) -> None:
             asyncio.run_coroutine_threadsafe(handle_after(guild_id, error), bot.loop)
 
-        source = discord.FFmpegPCMAudio(track.stream_url, executable=ffmpeg_exec, **FFMPEG_OPTIONS)
-        # Apply volume
-        source = discord.PCMVolumeTransformer(source, volume=state.volume)
-        
+        source = take_prepared(state, track)
+        if source is None:
+            # Link ký tên có thể đã hết hạn nếu bài nằm trong hàng đợi lâu
+            if track.needs_refresh():
+                try:
+                    await refresh_track(track, guild_id)
+                except ValueError as exc:
+                    logging.warning("Không làm mới được stream của %s: %s", track.title, exc)
+                    if not track.stream_url:
+                        # Bài playlist không resolve được: bỏ qua, phát bài sau
+                        state.now_playing = None
+                        if state.text_channel:
+                            await state.text_channel.send(f"Bỏ qua **{track.title}** vì em không lấy được nhạc 😿")
+                        await play_next(guild_id)
+                        return
+            source = build_source(track, ffmpeg_exec, state.volume)
+
         try:
             voice_client.play(source, after=after_play)
         except discord.ClientException as exc:
             logging.error("Không thể phát tại guild %s: %s", guild_id, exc)
+            source.cleanup()
             state.queue.appendleft(track)
             return
 
+        state.mark_started()
+
+        # Add to history if not looping one song
+        if state.loop_mode != "one":
+            state.play_history.append(HistoryEntry.from_track(track))
+
+        schedule_prefetch(guild_id)
+        schedule_resolve_ahead(guild_id)
+        schedule_queue_snapshot(guild_id)
+
         if state.text_channel:
             loop_emoji = ""
             if state.loop_mode == "one":
@@ -434,7 +945,9 @@ def setup(bot_instance: commands.Bot) -> None:
 
     async def handle_after(guild_id: int, error: Optional[Exception]) -> None:
         state = music_states.get(guild_id)
-        if state:
+        # Loop "one" giữ now_playing để play_next (và peek_next) phát lại đúng bài đó;
+        # +skip tự xoá now_playing trước khi stop nên vẫn qua bài được
+        if state and (error or state.loop_mode != "one"):
             state.now_playing = None
         if error:
             logging.error("Playback error tại guild %s: %s", guild_id, error)
@@ -478,6 +991,104 @@ def setup(bot_instance: commands.Bot) -> None:
             ai.current_model = model_name
             await ctx.reply(f"✅ Đã đổi model sang: `{model_name}`", mention_author=False)
     
+    @bot.command(name="aistream", help="Bật/tắt streaming câu trả lời AI (owner)")
+    async def aistream_cmd(ctx: commands.Context, mode: str = None) -> None:
+        if ctx.author.id not in OWNER_IDS:
+            await ctx.reply("chỉ có anh yêu của tớ mới được dùng thôi ro!", mention_author=False)
+            return
+        
+        if mode is None:
+            ai.stream_replies = not ai.stream_replies
+        elif mode.lower() in ["on", "1", "true"]:
+            ai.stream_replies = True
+        elif mode.lower() in ["off", "0", "false"]:
+            ai.stream_replies = False
+        else:
+            await ctx.reply("Dùng: `+aistream [on/off]` nha~", mention_author=False)
+            return
+        
+        status = "bật" if ai.stream_replies else "tắt"
+        await ctx.reply(f"✅ Streaming AI đã {status}!", mention_author=False)
+    
+    @bot.command(name="aicache", help="Bật/tắt/xoá cache câu trả lời AI (owner)")
+    async def aicache_cmd(ctx: commands.Context, mode: str = None) -> None:
+        if ctx.author.id not in OWNER_IDS:
+            await ctx.reply("chỉ có anh yêu của tớ mới được dùng thôi ro!", mention_author=False)
+            return
+        
+        if mode is None:
+            ai.cache_replies = not ai.cache_replies
+        elif mode.lower() in ["on", "1", "true"]:
+            ai.cache_replies = True
+        elif mode.lower() in ["off", "0", "false"]:
+            ai.cache_replies = False
+        elif mode.lower() == "clear":
+            ai.response_cache.clear()
+            await ctx.reply("🧹 Đã xoá cache câu trả lời AI!", mention_author=False)
+            return
+        else:
+            await ctx.reply("Dùng: `+aicache [on/off/clear]` nha~", mention_author=False)
+            return
+        
+        status = "bật" if ai.cache_replies else "tắt"
+        await ctx.reply(f"✅ Cache câu trả lời AI đã {status}!", mention_author=False)
+    
+    @bot.command(name="aistats", help="Xem thống kê AI chat (owner)")
+    async def aistats_cmd(ctx: commands.Context) -> None:
+        if ctx.author.id not in OWNER_IDS:
+            await ctx.reply("chỉ có anh yêu của tớ mới được dùng thôi ro!", mention_author=False)
+            return
+        
+        history_stats = ai.conversation_cache.stats()
+        embed = discord.Embed(title="🤖 AI Stats", color=discord.Color.blue())
+        embed.add_field(
+            name="💬 History cache",
+            value=(
+                f"Users: **{history_stats['users']}** ({history_stats['chars']:,} chars)\n"
+                f"Hit/Miss: **{history_stats['hits']}**/**{history_stats['misses']}** "
+                f"({history_stats['hit_rate']:.1f}%)\n"
+                f"Evictions: **{history_stats['evictions']}** • Dirty: **{history_stats['dirty']}**"
+            ),
+            inline=False
+        )
+        
+        limiter_stats = ai.admission.stats()
+        embed.add_field(
+            name="🚦 Request queue",
+            value=(
+                f"Queued: **{limiter_stats['queued']}** (peak {limiter_stats['peak_queued']}) • "
+                f"In flight: **{limiter_stats['in_flight']}/{limiter_stats['max_in_flight']}**\n"
+                f"Admitted: **{limiter_stats['admitted']}** • Rejected: **{limiter_stats['rejected']}**\n"
+                f"Wait avg/p95/max: **{limiter_stats['wait_avg_ms']:.0f}**/"
+                f"**{limiter_stats['wait_p95_ms']:.0f}**/**{limiter_stats['wait_max_ms']:.0f}** ms"
+            ),
+            inline=False
+        )
+        
+        prompt_stats = ai.prompt_builder.stats()
+        embed.add_field(
+            name="🧾 Prompt budget",
+            value=(
+                f"Budget: **{prompt_stats['budget']}** tokens • Prompts built: **{prompt_stats['builds']}**\n"
+                f"Turns folded: **{prompt_stats['folded_turns']}** • "
+                f"Summaries: **{prompt_stats['summaries']}** (refreshed {prompt_stats['summary_refreshes']}x)"
+            ),
+            inline=False
+        )
+        
+        cache_stats = ai.response_cache.stats()
+        embed.add_field(
+            name="⚡ Response cache",
+            value=(
+                f"Entries: **{cache_stats['entries']}** • {'bật' if ai.cache_replies else 'tắt'}\n"
+                f"Hit/Fuzzy/Miss: **{cache_stats['hits']}**/**{cache_stats['fuzzy_hits']}**/"
+                f"**{cache_stats['misses']}** ({cache_stats['hit_rate']:.1f}%)\n"
+                f"Latency saved: **{cache_stats['latency_saved_s']:.1f}s**"
+            ),
+            inline=False
+        )
+        await ctx.reply(embed=embed, mention_author=False)
+    
     @bot.command(name="testpersonality", help="Test personality consistency (owner)")
     async def testpersonality_cmd(ctx: commands.Context) -> None:
         if ctx.author.id not in OWNER_IDS:
@@ -523,11 +1134,11 @@ def setup(bot_instance: commands.Bot) -> None:
 
     def build_help_embed() -> discord.Embed:
         music_lines = [
-            "`+play <từ khóa/link>` – Phát nhạc",
+            "`+play <từ khóa/link/playlist>` – Phát nhạc",
             "`+skip` – Bỏ qua bài",
             "`+pause/resume` – Tạm dừng/phát tiếp",
             "`+stop` – Dừng và xoá queue",
-            "`+queue` – Xem hàng đợi",
+            "`+queue [trang]` – Xem hàng đợi",
             "`+np` – Bài đang phát",
             "`+loop [off/one/all]` – Lặp lại",
             "`+shuffle` – Xáo trộn queue",
@@ -541,7 +1152,8 @@ def setup(bot_instance: commands.Bot) -> None:
             "`+deposit/withdraw <số>` – Gửi/rút bank",
             "`+give @user <số>` – Chuyển tiền",
             "`+stats [@user]` – Xem thống kê",
-            "`+leaderboard` – Top giàu nhất"
+            "`+leaderboard` – Top giàu nhất",
+            "`+lbcard` – Top giàu nhất dạng ảnh 🖼️"
         ]
         
         casino_lines = [
@@ -650,8 +1262,11 @@ def setup(bot_instance: commands.Bot) -> None:
         if voice_client is None:
             return
 
+        if is_playlist_url(query):
+            return await enqueue_playlist(ctx, voice_client, query)
+
         try:
-            track = await extract_track(query)
+            track = await extract_track(query, guild_id=ctx.guild.id)
         except ValueError as exc:
             logging.exception("Không lấy được thông tin bài hát: %s", exc)
             return await ctx.reply("Em chưa tìm ra bài đó, thử keyword khác giúp em nha~", mention_author=False)
@@ -660,12 +1275,35 @@ def setup(bot_instance: commands.Bot) -> None:
         state.queue.append(track)
         state.text_channel = ctx.channel
         cancel_auto_leave(state)
+        schedule_queue_snapshot(ctx.guild.id)
 
         if voice_client.is_playing() or voice_client.is_paused():
             await ctx.reply(f"Đã thêm **{track.title}** vào hàng đợi ❤️", mention_author=False)
         else:
             await play_next(ctx.guild.id)
 
+    async def enqueue_playlist(ctx: commands.Context, voice_client: discord.VoiceClient, query: str) -> None:
+        try:
+            title, tracks = await extract_playlist(query, guild_id=ctx.guild.id)
+        except ValueError as exc:
+            logging.exception("Không lấy được playlist: %s", exc)
+            return await ctx.reply("Em chưa mở được playlist đó, kiểm tra lại link giúp em nha~", mention_author=False)
+
+        if not tracks:
+            return await ctx.reply("Playlist này trống trơn nè~", mention_author=False)
+
+        state = get_state(ctx.guild.id)
+        state.queue.extend(tracks)
+        state.text_channel = ctx.channel
+        cancel_auto_leave(state)
+        schedule_queue_snapshot(ctx.guild.id)
+
+        # Bài đầu được resolve ngay trong play_next, mấy bài sau resolve song song
+        await ctx.reply(f"Đã thêm **{len(tracks)}** bài từ **{title}** vào hàng đợi ❤️", mention_author=False)
+        schedule_resolve_ahead(ctx.guild.id)
+        if not voice_client.is_playing() and not voice_client.is_paused():
+            await play_next(ctx.guild.id)
+
     @bot.command(name="skip", aliases=["s"], help="Bỏ qua bài đang phát")
     async def skip(ctx: commands.Context) -> None:
         state = music_states.get(ctx.guild.id)
@@ -676,25 +1314,33 @@ def setup(bot_instance: commands.Bot) -> None:
         if not voice_client.is_playing():
             return await ctx.reply("Không có bài nào đang phát để skip hết~", mention_author=False)
 
+        # Clear first so loop "one" moves on instead of replaying the skipped track
+        state.now_playing = None
         voice_client.stop()
         await ctx.reply("Đã skip nha!", mention_author=False)
 
-    @bot.command(name="queue", aliases=["q"], help="Xem hàng đợi")
-    async def queue_cmd(ctx: commands.Context) -> None:
-        state = music_states.get(ctx.guild.id)
+    @bot.command(name="queue", aliases=["q"], help="Xem hàng đợi (theo trang)")
+    async def queue_cmd(ctx: commands.Context, page: int = 1) -> None:
+        state = find_state(ctx.guild.id)
         if not state or (not state.queue and not state.now_playing):
             return await ctx.reply("Hàng đợi trống trơn nè~", mention_author=False)
 
+        total = len(state.queue)
+        pages = max(1, -(-total // QUEUE_PAGE_SIZE))
+        page = max(1, min(page, pages))
+        start = (page - 1) * QUEUE_PAGE_SIZE
+
         entries = []
         if state.now_playing:
             entries.append(f"**Đang phát:** {state.now_playing.title}")
 
-        for idx, track in enumerate(state.queue, start=1):
+        # Chỉ lấy đúng trang cần xem, không duyệt cả hàng đợi
+        for idx, track in enumerate(state.queue[start:start + QUEUE_PAGE_SIZE], start=start + 1):
             entries.append(f"{idx}. {track.title}")
 
-        text = "\n".join(entries[:15])
-        if len(entries) > 15:
-            text += f"\n... và {len(entries) - 15} bài nữa"
+        text = "\n".join(entries)
+        if pages > 1:
+            text += f"\nTrang {page}/{pages} • {total} bài (`+queue <trang>`)"
 
         await ctx.reply(text, mention_author=False)
 
@@ -705,6 +1351,9 @@ def setup(bot_instance: commands.Bot) -> None:
             return await ctx.reply("Em đâu có phát bài nào để pause đâu~", mention_author=False)
 
         voice_client.pause()
+        state = music_states.get(ctx.guild.id)
+        if state:
+            state.paused_at = time.monotonic()
         await ctx.reply("Đã pause nha~", mention_author=False)
 
     @bot.command(name="resume", help="Tiếp tục phát nhạc")
@@ -714,15 +1363,21 @@ def setup(bot_instance: commands.Bot) -> None:
             return await ctx.reply("Không có bài nào tạm dừng để resume nha~", mention_author=False)
 
         voice_client.resume()
+        state = music_states.get(ctx.guild.id)
+        if state and state.paused_at:
+            state.play_started_at += time.monotonic() - state.paused_at
+            state.paused_at = None
         await ctx.reply("Phát tiếp nè~", mention_author=False)
 
     @bot.command(name="stop", help="Dừng nhạc và xoá hàng đợi")
     async def stop(ctx: commands.Context) -> None:
-        state = music_states.get(ctx.guild.id)
+        state = find_state(ctx.guild.id)
         voice_client = ctx.voice_client
         if state:
             state.queue.clear()
             state.now_playing = None
+            cancel_prefetch(state)
+            schedule_queue_snapshot(ctx.guild.id)
 
         if voice_client and voice_client.is_playing():
             voice_client.stop()
@@ -744,12 +1399,15 @@ def setup(bot_instance: commands.Bot) -> None:
             state.voice_client = None
             state.now_playing = None
             cancel_auto_leave(state)
+            cancel_prefetch(state)
+            schedule_queue_snapshot(ctx.guild.id)
         await ctx.reply("Em out voice rồi nè~", mention_author=False)
 
     @bot.command(name="stay", help="Bật/tắt chế độ ở lại voice sau khi hết nhạc")
     async def stay(ctx: commands.Context) -> None:
         state = get_state(ctx.guild.id)
         state.stay_mode = not state.stay_mode
+        schedule_queue_snapshot(ctx.guild.id)
         status = "bật" if state.stay_mode else "tắt"
         if state.stay_mode:
             cancel_auto_leave(state)
@@ -766,38 +1424,38 @@ def setup(bot_instance: commands.Bot) -> None:
 
     @bot.command(name="move", help="Di chuyển một bài trong hàng đợi đến vị trí mới")
     async def move_track(ctx: commands.Context, current_index: int, new_index: int) -> None:
-        state = music_states.get(ctx.guild.id)
+        state = find_state(ctx.guild.id)
         if not state or not state.queue:
             return await ctx.reply("Hàng đợi trống trơn nè~", mention_author=False)
 
-        queue_list = list(state.queue)
-        if current_index < 1 or current_index > len(queue_list):
+        if current_index < 1 or current_index > len(state.queue):
             return await ctx.reply("Vị trí hiện tại không hợp lệ nha~", mention_author=False)
 
-        new_index_clamped = max(1, min(new_index, len(queue_list)))
-        track = queue_list.pop(current_index - 1)
-        queue_list.insert(new_index_clamped - 1, track)
-        state.queue = deque(queue_list)
+        new_index_clamped = max(1, min(new_index, len(state.queue)))
+        previous_next = peek_next(state)
+        track = state.queue.move(current_index - 1, new_index_clamped - 1)
+        queue_reordered(ctx.guild.id, state, previous_next)
 
         await ctx.reply(f"Đã chuyển **{track.title}** tới vị trí {new_index_clamped} nha~", mention_author=False)
 
     @bot.command(name="remove", aliases=["rm"], help="Xoá một bài khỏi hàng đợi")
     async def remove_track(ctx: commands.Context, index: int) -> None:
-        state = music_states.get(ctx.guild.id)
+        state = find_state(ctx.guild.id)
         if not state or not state.queue:
             return await ctx.reply("Hàng đợi trống trơn nè~", mention_author=False)
 
-        queue_list = list(state.queue)
-        if index < 1 or index > len(queue_list):
+        if index < 1 or index > len(state.queue):
             return await ctx.reply("Vị trí đó không có bài nào hết nha~", mention_author=False)
 
-        removed_track = queue_list.pop(index - 1)
-        state.queue = deque(queue_list)
+        previous_next = peek_next(state)
+        removed_track = state.queue.pop(index - 1)
+        queue_reordered(ctx.guild.id, state, previous_next)
         await ctx.reply(f"Đã xoá **{removed_track.title}** khỏi hàng đợi nha~", mention_author=False)
 
     @bot.command(name="loop", aliases=["repeat"], help="Bật/tắt chế độ lặp (off/one/all)")
     async def loop_cmd(ctx: commands.Context, mode: str = None) -> None:
         state = get_state(ctx.guild.id)
+        schedule_queue_snapshot(ctx.guild.id)
         
         if mode is None:
             # Cycle through modes
@@ -826,15 +1484,14 @@ def setup(bot_instance: commands.Bot) -> None:
 
     @bot.command(name="shuffle", help="Xáo trộn hàng đợi")
     async def shuffle_cmd(ctx: commands.Context) -> None:
-        state = music_states.get(ctx.guild.id)
+        state = find_state(ctx.guild.id)
         if not state or not state.queue:
             return await ctx.reply("Hàng đợi trống nên không shuffle được nha~", mention_author=False)
 
-        import random
-        queue_list = list(state.queue)
-        random.shuffle(queue_list)
-        state.queue = deque(queue_list)
-        await ctx.reply(f"Đã xáo trộn {len(queue_list)} bài trong hàng đợi 🔀", mention_author=False)
+        previous_next = peek_next(state)
+        state.queue.shuffle()
+        queue_reordered(ctx.guild.id, state, previous_next)
+        await ctx.reply(f"Đã xáo trộn {len(state.queue)} bài trong hàng đợi 🔀", mention_author=False)
 
     @bot.command(name="volume", aliases=["vol"], help="Điều chỉnh âm lượng (0-100)")
     async def volume_cmd(ctx: commands.Context, volume: int = None) -> None:
@@ -849,22 +1506,42 @@ def setup(bot_instance: commands.Bot) -> None:
             return await ctx.reply("Âm lượng phải từ 0 đến 100 nha~", mention_author=False)
         
         state.volume = volume / 100.0
+        schedule_queue_snapshot(ctx.guild.id)
+        # Bài đã warm sẵn dùng âm lượng cũ
+        discard_prepared(state)
         
-        # Update current playing track volume
-        if voice_client and voice_client.source:
-            if isinstance(voice_client.source, discord.PCMVolumeTransformer):
-                voice_client.source.volume = state.volume
+        # Âm lượng nằm trong FFmpeg, nên restart FFmpeg ở vị trí hiện tại với filter mới
+        track = state.now_playing
+        ffmpeg_exec = resolve_ffmpeg_path()
+        if voice_client and voice_client.source and track and ffmpeg_exec:
+            position = state.position()
+            was_paused = voice_client.is_paused()
+            if track.needs_refresh(0):
+                try:
+                    await refresh_track(track, ctx.guild.id)
+                except ValueError as exc:
+                    logging.warning("Không làm mới được stream của %s: %s", track.title, exc)
+            old_source = voice_client.source
+            voice_client.source = build_source(track, ffmpeg_exec, state.volume, start_at=position)
+            state.mark_started(position)
+            if was_paused:
+                voice_client.pause()
+                state.paused_at = time.monotonic()
+            # Player thread có thể vẫn đang đọc frame cuối của source cũ
+            bot.loop.call_later(1, old_source.cleanup)
         
         await ctx.reply(f"Đã đặt âm lượng thành **{volume}%** 🔊", mention_author=False)
 
     @bot.command(name="history", aliases=["hist"], help="Xem lịch sử phát nhạc")
     async def history_cmd(ctx: commands.Context) -> None:
         state = music_states.get(ctx.guild.id)
-        if not state or not state.play_history:
+        # Guild đã bị evict thì đọc lịch sử từ storage
+        play_history = state.play_history if state else load_history(ctx.guild.id)
+        if not play_history:
             return await ctx.reply("Chưa có lịch sử phát nhạc nào nè~", mention_author=False)
 
         entries = []
-        for idx, track in enumerate(reversed(list(state.play_history)), start=1):
+        for idx, track in enumerate(reversed(list(play_history)), start=1):
             entries.append(f"{idx}. {track.title}")
             if idx >= 10:
                 break
@@ -872,6 +1549,86 @@ def setup(bot_instance: commands.Bot) -> None:
         text = "**Lịch sử phát nhạc (10 bài gần nhất):**\n" + "\n".join(entries)
         await ctx.reply(text, mention_author=False)
 
+    @bot.command(name="musicmem", help="Xem RAM mà music state của từng server đang dùng (owner)")
+    async def musicmem_cmd(ctx: commands.Context) -> None:
+        if ctx.author.id not in OWNER_IDS:
+            await ctx.reply("chỉ có anh yêu của tớ mới được dùng thôi ro!", mention_author=False)
+            return
+        
+        footprints = sorted(
+            ((guild_id, state.footprint(), state) for guild_id, state in music_states.items()),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        total = sum(size for _, size, _ in footprints)
+        idle = sum(1 for _, _, state in footprints if state.is_idle())
+        
+        lines = []
+        for guild_id, size, state in footprints[:10]:
+            guild = bot.get_guild(guild_id)
+            name = guild.name if guild else str(guild_id)
+            lines.append(
+                f"`{size / 1024:7.1f} KB` {name} • queue {len(state.queue)} • history {len(state.play_history)}"
+            )
+        
+        embed = discord.Embed(title="🧠 Music Memory", color=discord.Color.purple())
+        embed.add_field(
+            name="Tổng quan",
+            value=(
+                f"States: **{len(footprints)}** (idle {idle}) • Total: **{total / 1024:.1f} KB**\n"
+                f"Evicted: **{music_evictions}** • Offloaded histories: **{len(music_history_table.rows)}**"
+            ),
+            inline=False
+        )
+        embed.add_field(name="Top servers", value="\n".join(lines) or "Chưa có server nào~", inline=False)
+        await ctx.reply(embed=embed, mention_author=False)
+
+    @bot.command(name="musicstats", help="Xem thống kê hệ thống nhạc (owner)")
+    async def musicstats_cmd(ctx: commands.Context) -> None:
+        if ctx.author.id not in OWNER_IDS:
+            await ctx.reply("chỉ có anh yêu của tớ mới được dùng thôi ro!", mention_author=False)
+            return
+        
+        cache_stats = track_cache.stats()
+        embed = discord.Embed(title="🎶 Music Stats", color=discord.Color.purple())
+        embed.add_field(
+            name="🎧 Extraction cache",
+            value=(
+                f"Queries: **{cache_stats['queries']}** • Tracks: **{cache_stats['tracks']}** • "
+                f"Disk: **{cache_stats['disk_rows']}** rows\n"
+                f"Hit/Stale/Miss: **{cache_stats['hits']}**/**{cache_stats['stale_hits']}**/"
+                f"**{cache_stats['misses']}** ({cache_stats['hit_rate']:.1f}%)\n"
+                f"Disk hits: **{cache_stats['disk_hits']}**"
+            ),
+            inline=False
+        )
+        
+        pool_stats = extraction_pool.stats(ctx.guild.id if ctx.guild else None)
+        total = pool_stats["total"]
+        embed.add_field(
+            name="⚙️ Extraction pool",
+            value=(
+                f"Workers: **{pool_stats['workers']}** • In flight: **{pool_stats['inflight']}** • "
+                f"Peak depth: **{total.peak_depth}**\n"
+                f"Done/Failed/Coalesced: **{total.completed}**/**{total.failed}**/**{total.coalesced}**\n"
+                f"`{format_histogram(total.histogram)}`"
+            ),
+            inline=False
+        )
+        guild_stats = pool_stats["guild"]
+        if guild_stats:
+            embed.add_field(
+                name="🏠 Server này",
+                value=(
+                    f"Depth: **{guild_stats.depth}** (peak {guild_stats.peak_depth}) • "
+                    f"Done/Failed/Coalesced: **{guild_stats.completed}**/**{guild_stats.failed}**/"
+                    f"**{guild_stats.coalesced}**\n"
+                    f"`{format_histogram(guild_stats.histogram)}`"
+                ),
+                inline=False
+            )
+        await ctx.reply(embed=embed, mention_author=False)
+
     @bot.command(name="reset", aliases=["clear"], help="Xóa lịch sử chat với AI")
     async def reset_ai(ctx: commands.Context) -> None:
         user_id = str(ctx.author.id)
@@ -889,8 +1646,11 @@ def setup(bot_instance: commands.Bot) -> None:
         import os
         import json
         
+        # Write cached conversations first so the files are up to date
+        ai.conversation_cache.flush()
+        
         cleaned = 0
-        history_dir = "user_histories"
+        history_dir = ai.conversation_cache.history_dir
         
         if not os.path.exists(history_dir):
             await ctx.reply("Không có history folder!", mention_author=False)
@@ -2163,29 +2923,67 @@ def setup(bot_instance: commands.Bot) -> None:
         
         await ctx.reply(embed=embed, mention_author=False)
     
-    @bot.command(name="card", aliases=["profile-card", "pc"], help="Generate profile card image")
-    async def card_cmd(ctx: commands.Context, member: discord.Member = None) -> None:
-        member = member or ctx.author
-        user_id = str(member.id)
-        stats = economy.get_stats(user_id)
+    # Output format of +card per server: guild_id -> {"format": name}
+    card_format_table = StorageTable("card_formats")
+    
+    def card_format_for(guild: Optional[discord.Guild]) -> str:
+        row = card_format_table.rows.get(str(guild.id)) if guild else None
+        return row["format"] if row else CARD_FORMAT
+    
+    @bot.command(name="cardformat", help="Chọn định dạng ảnh cho +card ở server này (owner)")
+    async def cardformat_cmd(ctx: commands.Context, output_format: str = None) -> None:
+        if ctx.author.id not in OWNER_IDS:
+            await ctx.reply("chỉ có anh yêu của tớ mới được dùng thôi ro!", mention_author=False)
+            return
+        if ctx.guild is None:
+            await ctx.reply("Lệnh này chỉ dùng trong server nha~", mention_author=False)
+            return
         
-        # Get data
-        is_infinity = economy.is_infinity(user_id)
-        level = stats.get("level", 1)
-        xp = stats.get("xp", 0)
-        xp_needed = economy.get_xp_for_level(level)
-        balance = stats.get("balance", 0)
-        bank = stats.get("bank", 0)
-        streak = stats.get("daily_streak", 0)
-        wins = stats.get("wins", 0)
-        losses = stats.get("losses", 0)
+        choices = ["auto", *CARD_ENCODERS]
+        if output_format is None:
+            lines = []
+            for name, stats in profile_card_generator.encoder_stats.items():
+                if stats.samples:
+                    lines.append(
+                        f"`{name}` • {stats.encode_ms:.1f} ms • {stats.size_bytes / 1024:.1f} KB • "
+                        f"cost {stats.cost_ms():.1f} ms ({stats.samples} lần)"
+                    )
+            cache = profile_card_generator.card_stats()
+            embed = discord.Embed(title="🖼️ Card Format", color=discord.Color.purple())
+            embed.add_field(
+                name="Server này",
+                value=f"**{card_format_for(ctx.guild)}** • Chọn: {', '.join(f'`{c}`' for c in choices)}",
+                inline=False
+            )
+            embed.add_field(name="Encoders", value="\n".join(lines) or "Chưa render card nào~", inline=False)
+            embed.add_field(
+                name="Output cache",
+                value=(
+                    f"Cards: **{cache['cards']}** • {cache['bytes'] / 1024 / 1024:.1f}/{cache['limit'] / 1024 / 1024:.0f} MB • "
+                    f"Hit rate: **{cache['hit_rate']:.1f}%**"
+                ),
+                inline=False
+            )
+            await ctx.reply(embed=embed, mention_author=False)
+            return
         
-        # Get avatar URL
-        avatar_url = member.display_avatar.url
+        output_format = output_format.lower()
+        if output_format not in choices:
+            await ctx.reply(f"Dùng: `+cardformat [{'/'.join(choices)}]` nha~", mention_author=False)
+            return
+        card_format_table.rows[str(ctx.guild.id)] = {"format": output_format}
+        card_format_table.mark_dirty(str(ctx.guild.id))
+        await ctx.reply(f"✅ +card ở server này giờ dùng **{output_format}**", mention_author=False)
+    
+    async def collect_card_fields(user: discord.abc.User) -> Dict:
+        """Everything generate_profile_card needs for one user"""
+        user_id = str(user.id)
+        stats = economy.get_stats(user_id)
+        level = stats.get("level", 1)
         
         # Get equipped items
-        equipped_ring_id = shop_system.get_equipped_item(str(member.id), "ring")
-        equipped_pet_id = shop_system.get_equipped_item(str(member.id), "pet")
+        equipped_ring_id = shop_system.get_equipped_item(user_id, "ring")
+        equipped_pet_id = shop_system.get_equipped_item(user_id, "pet")
         
         equipped_ring_name = None
         equipped_pet_name = None
@@ -2200,39 +2998,51 @@ def setup(bot_instance: commands.Bot) -> None:
         
         # Get marriage partner
         partner_name = None
-        if marriage_system.is_married(str(member.id)):
-            partner_id = marriage_system.get_partner(str(member.id))
+        if marriage_system.is_married(user_id):
+            partner_id = marriage_system.get_partner(user_id)
             try:
-                partner = await bot.fetch_user(int(partner_id))
+                partner = bot.get_user(int(partner_id)) or await bot.fetch_user(int(partner_id))
                 partner_name = partner.display_name
             except:
                 pass
         
+        return {
+            "username": user.display_name,
+            "avatar_url": user.display_avatar.url,
+            "level": level,
+            "xp": stats.get("xp", 0),
+            "xp_needed": economy.get_xp_for_level(level),
+            "balance": stats.get("balance", 0),
+            "bank": stats.get("bank", 0),
+            "streak": stats.get("daily_streak", 0),
+            "wins": stats.get("wins", 0),
+            "losses": stats.get("losses", 0),
+            "is_infinity": economy.is_infinity(user_id),
+            "equipped_ring": equipped_ring_name,
+            "equipped_pet": equipped_pet_name,
+            "partner_name": partner_name,
+        }
+    
+    @bot.command(name="card", aliases=["profile-card", "pc"], help="Generate profile card image")
+    async def card_cmd(ctx: commands.Context, member: discord.Member = None) -> None:
+        member = member or ctx.author
+        fields = await collect_card_fields(member)
+        
         # Show typing indicator
         async with ctx.typing():
             try:
                 # Generate card
                 card_image = await profile_card_generator.generate_profile_card(
-                    username=member.display_name,
-                    avatar_url=avatar_url,
-                    level=level,
-                    xp=xp,
-                    xp_needed=xp_needed,
-                    balance=balance,
-                    bank=bank,
-                    streak=streak,
-                    wins=wins,
-                    losses=losses,
-                    is_infinity=is_infinity,
-                    equipped_ring=equipped_ring_name,
-                    equipped_pet=equipped_pet_name,
-                    partner_name=partner_name
+                    **fields,
+                    output_format=card_format_for(ctx.guild)
                 )
                 
-                # Send as file
-                file = discord.File(card_image, filename=f"{member.name}_profile.png")
+                # Send as file (extension depends on the chosen encoder)
+                file = discord.File(card_image, filename=f"{member.name}_{card_image.name}")
                 await ctx.reply(file=file, mention_author=False)
                 
+            except CardQueueFull:
+                await ctx.reply("⏳ Đang vẽ nhiều card quá, thử lại sau chút nha~", mention_author=False)
             except Exception as e:
                 await ctx.reply(f"❌ Lỗi khi tạo profile card: {e}", mention_author=False)
                 logging.exception("Error generating profile card")
@@ -2311,6 +3121,42 @@ def setup(bot_instance: commands.Bot) -> None:
         embed.description = "\n".join(description) if description else "No data yet!"
         await ctx.reply(embed=embed, mention_author=False)
     
+    @bot.command(name="lbcard", aliases=["topcard"], help="Bảng xếp hạng giàu nhất dạng ảnh (gallery card)")
+    async def lbcard_cmd(ctx: commands.Context) -> None:
+        sorted_users = sorted(
+            economy.data.items(),
+            key=lambda x: x[1]["balance"] + x[1]["bank"],
+            reverse=True
+        )[:10]
+        
+        async def resolve_user(user_id: str) -> Optional[discord.User]:
+            try:
+                return bot.get_user(int(user_id)) or await bot.fetch_user(int(user_id))
+            except:
+                return None
+        
+        async with ctx.typing():
+            # Users + card data in parallel; the gallery then fetches avatars in parallel too
+            users = await asyncio.gather(*(resolve_user(user_id) for user_id, _ in sorted_users))
+            users = [user for user in users if user is not None]
+            if not users:
+                await ctx.reply("No data yet!", mention_author=False)
+                return
+            entries = await asyncio.gather(*(collect_card_fields(user) for user in users))
+            
+            try:
+                gallery = await profile_card_generator.generate_gallery(
+                    list(entries),
+                    output_format=card_format_for(ctx.guild)
+                )
+                file = discord.File(gallery, filename=f"leaderboard_{gallery.name}")
+                await ctx.reply("🏆 **Top 10 Richest Users**", file=file, mention_author=False)
+            except CardQueueFull:
+                await ctx.reply("⏳ Đang vẽ nhiều card quá, thử lại sau chút nha~", mention_author=False)
+            except Exception as e:
+                await ctx.reply(f"❌ Lỗi khi tạo leaderboard card: {e}", mention_author=False)
+                logging.exception("Error generating leaderboard gallery")
+    
     # ==================== AFK SYSTEM ====================
     
     @bot.command(name="afk", help="Đặt trạng thái AFK")
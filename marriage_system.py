@@ -3,33 +3,25 @@ Marriage System - Hệ thống cưới cho Discord bot
 Cho phép users cưới nhau và nhận benefits
 """
 
-import json
-import os
 from datetime import datetime
 from typing import Optional, Tuple, Dict
 
+from storage import StorageTable
+
 class MarriageSystem:
     """Manage marriages between users"""
     
     def __init__(self):
-        self.data_file = "marriage_data.json"
         self.load_data()
     
     def load_data(self):
         """Load marriage data"""
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    self.marriages = json.load(f)
-            except:
-                self.marriages = {}
-        else:
-            self.marriages = {}
+        self.table = StorageTable("marriages")
+        self.marriages = self.table.rows
     
-    def save_data(self):
-        """Save marriage data"""
-        with open(self.data_file, 'w', encoding='utf-8') as f:
-            json.dump(self.marriages, f, ensure_ascii=False, indent=2)
+    def save_data(self, *user_ids: str):
+        """Schedule a write-behind save of the given users' marriage rows"""
+        self.table.mark_dirty(*user_ids)
     
     def is_married(self, user_id: str) -> bool:
         """Check if user is married"""
@@ -86,7 +78,7 @@ class MarriageSystem:
             "love_points": 0
         }
         
-        self.save_data()
+        self.save_data(user1_id, user2_id)
         return True, f"🎉 Chúc mừng! Hai bạn đã kết hôn! 💍✨"
     
     def divorce(self, user_id: str) -> Tuple[bool, str]:
@@ -101,7 +93,7 @@ class MarriageSystem:
         if partner_id and partner_id in self.marriages:
             del self.marriages[partner_id]
         
-        self.save_data()
+        self.save_data(user_id, partner_id)
         return True, "💔 Hai bạn đã ly hôn..."
     
     def add_love_points(self, user_id: str, points: int) -> bool:
@@ -116,7 +108,7 @@ class MarriageSystem:
         if partner_id and partner_id in self.marriages:
             self.marriages[partner_id]["love_points"] += points
         
-        self.save_data()
+        self.save_data(user_id, partner_id)
         return True
     
     def get_marriage_duration(self, user_id: str) -> Optional[str]:
@@ -0,0 +1,166 @@
+"""
+NVIDIA Client - Async client cho NVIDIA API (OpenAI-compatible)
+Một aiohttp session dùng chung cho cả bot: keep-alive, giới hạn connection, retry có backoff
+"""
+
+import asyncio
+import json
+import logging
+import random
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+
+from http_session import create_pooled_session
+
+logger = logging.getLogger(__name__)
+
+NVIDIA_API_URL = "https://integrate.api.nvidia.com/v1/chat/completions"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class NvidiaAPIError(Exception):
+    """Non-2xx response from the NVIDIA API (after retries)"""
+
+    def __init__(self, status: int, body: str):
+        super().__init__(f"NVIDIA API trả về {status}")
+        self.status = status
+        self.body = body
+
+
+class NvidiaClient:
+    """Long-lived HTTP client for chat completions"""
+
+    def __init__(
+        self,
+        url: str = NVIDIA_API_URL,
+        max_connections: int = 10,
+        timeout: float = 30,
+        max_retries: int = 2,
+        backoff_factor: float = 0.5,
+    ):
+        self.url = url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Create the shared session on first use (needs a running event loop)"""
+        if self._session is None or self._session.closed:
+            self._session = create_pooled_session(self.max_connections)
+        return self._session
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), 10.0)
+            except ValueError:
+                pass
+        # Exponential backoff with a little jitter so bursts don't retry in lockstep
+        return self.backoff_factor * (2 ** attempt) + random.uniform(0, 0.1)
+
+    def _headers(self, api_key: str) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+
+    async def chat_completion(self, api_key: str, payload: Dict, timeout: Optional[float] = None) -> Dict:
+        """POST a chat completion and return the decoded JSON body"""
+        session = self.get_session()
+        request_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.post(
+                    self.url,
+                    headers=self._headers(api_key),
+                    json=payload,
+                    timeout=request_timeout,
+                ) as resp:
+                    if resp.status in RETRY_STATUSES and attempt < self.max_retries:
+                        delay = self._retry_delay(attempt, resp.headers.get("Retry-After"))
+                        logger.warning("NVIDIA API %s, thử lại sau %.2fs", resp.status, delay)
+                        await asyncio.sleep(delay)
+                        continue
+
+                    body = await resp.text()
+                    if resp.status >= 400:
+                        raise NvidiaAPIError(resp.status, body)
+                    return json.loads(body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("Lỗi kết nối NVIDIA API (%s), thử lại sau %.2fs", exc, delay)
+                await asyncio.sleep(delay)
+
+        raise RuntimeError("unreachable")
+
+    async def stream_chat_completion(
+        self, api_key: str, payload: Dict, timeout: Optional[float] = None
+    ) -> AsyncIterator[str]:
+        """POST with `stream: true` and yield text deltas from the SSE stream.
+
+        Retries only happen before the first token arrives; `timeout` bounds
+        the wait between two chunks rather than the whole completion.
+        """
+        session = self.get_session()
+        request_timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=timeout or self.timeout,
+            sock_read=timeout or self.timeout,
+        )
+        stream_payload = dict(payload, stream=True)
+        started = False
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.post(
+                    self.url,
+                    headers=dict(self._headers(api_key), Accept="text/event-stream"),
+                    json=stream_payload,
+                    timeout=request_timeout,
+                ) as resp:
+                    if resp.status in RETRY_STATUSES and attempt < self.max_retries:
+                        delay = self._retry_delay(attempt, resp.headers.get("Retry-After"))
+                        logger.warning("NVIDIA API %s, thử lại sau %.2fs", resp.status, delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    if resp.status >= 400:
+                        raise NvidiaAPIError(resp.status, await resp.text())
+
+                    async for raw_line in resp.content:
+                        line = raw_line.decode("utf-8", errors="replace").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            return
+
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            raise NvidiaAPIError(resp.status, data)
+                        for choice in chunk.get("choices") or []:
+                            delta = (choice.get("delta") or {}).get("content")
+                            if delta:
+                                started = True
+                                yield delta
+                    return
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                if started or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("Lỗi kết nối NVIDIA API (%s), thử lại sau %.2fs", exc, delay)
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Global instance
+nvidia_client = NvidiaClient()
@@ -4,10 +4,178 @@ Fast image generation for user profiles
 """
 
 import io
+import re
+import time
+import json
+import hashlib
+import asyncio
 import aiohttp
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from urllib.parse import urlparse
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 import os
+from dotenv import load_dotenv
+
+from http_session import create_pooled_session
+
+load_dotenv()
+
+# Render in worker processes so PIL never blocks the event loop (0 = render in a thread instead)
+CARD_RENDER_WORKERS = int(os.getenv("CARD_RENDER_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Cards waiting + rendering at once; further +card calls wait for a slot
+CARD_RENDER_QUEUE = int(os.getenv("CARD_RENDER_QUEUE", str(max(1, CARD_RENDER_WORKERS) * 4)))
+# How long a card waits for a slot before giving up
+CARD_QUEUE_TIMEOUT = 15
+
+# Avatar tiles (180px, circle-masked RGBA): ~130KB each in RAM, small PNGs in profile_cache/
+AVATAR_MEMORY_TILES = 128
+AVATAR_DISK_TILES = 2000
+AVATAR_DOWNLOAD_TIMEOUT = 10
+
+# Finished cards keyed by a hash of every card input; bounded by total bytes
+CARD_CACHE_MB = float(os.getenv("CARD_CACHE_MB", "32"))
+
+
+class CardEncoder(NamedTuple):
+    ext: str
+    format: str
+    options: Dict
+    palette: bool = False  # quantize to 256 colors first
+    scale: float = 1.0     # < 1 renders a smaller preview
+
+
+# Output encoders (all keep the alpha of the rounded corners)
+CARD_ENCODERS: Dict[str, CardEncoder] = {
+    "png": CardEncoder("png", "PNG", {"compress_level": 6}),             # old default: slow + large
+    "png-fast": CardEncoder("png", "PNG", {"compress_level": 1}),
+    "png-palette": CardEncoder("png", "PNG", {"compress_level": 6}, palette=True),
+    "webp": CardEncoder("webp", "WEBP", {"quality": 85, "method": 2}),
+    "webp-lossless": CardEncoder("webp", "WEBP", {"lossless": True, "quality": 0, "method": 0}),
+    "webp-preview": CardEncoder("webp", "WEBP", {"quality": 80, "method": 2}, scale=0.5),
+}
+# "auto" picks among these by measured encode time + upload cost. Only lossless
+# encoders: the cost model can't see banding, so png-palette/webp stay opt-in (+cardformat)
+AUTO_ENCODERS = ("png-fast", "webp-lossless")
+AUTO_MIN_SAMPLES = 3
+CARD_FORMAT = os.getenv("CARD_FORMAT", "auto").strip().lower()
+# Rough upload bandwidth to Discord, turns output size into milliseconds
+CARD_UPLOAD_KBPS = float(os.getenv("CARD_UPLOAD_KBPS", "1000"))
+
+# Gallery (leaderboard) layout: half-size cards in a grid
+GALLERY_COLUMNS = 2
+GALLERY_GAP = 12
+
+# Color scheme per level tier (OWO-inspired): 3 gradient stops + badge color
+TIER_COLORS = {
+    "infinity": ((255, 223, 0), (255, 165, 0), (255, 69, 0), (255, 215, 0)),   # Gold -> orange -> red-orange
+    "legend": ((147, 51, 234), (126, 34, 206), (75, 0, 130), (147, 51, 234)),  # Purple -> indigo
+    "veteran": ((59, 130, 246), (37, 99, 235), (29, 78, 216), (59, 130, 246)), # Blues
+    "default": ((34, 197, 94), (22, 163, 74), (21, 128, 61), (34, 197, 94)),   # Greens
+}
+
+
+# Card layout (static parts are pre-rendered into per-tier templates)
+AVATAR_SIZE = 180
+LEVEL_BADGE_X, LEVEL_BADGE_Y = 243, 110
+LEVEL_BADGE_WIDTH, LEVEL_BADGE_HEIGHT = 120, 50
+BAR_X, BAR_Y, BAR_WIDTH, BAR_HEIGHT = 243, 210, 620, 30
+STATS_Y = 270
+# (x, width, icon, label, icon color)
+STAT_CARDS = [
+    (40, 200, "💰", "WALLET", (255, 215, 0)),
+    (260, 200, "🏦", "BANK", (100, 149, 237)),
+    (480, 200, "🔥", "STREAK", (255, 69, 0)),
+    (700, 170, "🎮", "WIN RATE", (50, 205, 50)),
+]
+
+
+def card_tier(level: int, is_infinity: bool) -> str:
+    if is_infinity:
+        return "infinity"
+    if level >= 50:
+        return "legend"
+    if level >= 25:
+        return "veteran"
+    return "default"
+
+
+class CardQueueFull(Exception):
+    """Raised when the render queue stays full for CARD_QUEUE_TIMEOUT seconds"""
+
+
+@dataclass
+class CardData:
+    """Plain (picklable) inputs for one profile card"""
+    username: str
+    level: int
+    xp: int
+    xp_needed: int
+    balance: int
+    bank: int
+    streak: int
+    wins: int
+    losses: int
+    is_infinity: bool = False
+    equipped_ring: Optional[str] = None
+    equipped_pet: Optional[str] = None
+    partner_name: Optional[str] = None
+
+
+def avatar_cache_key(avatar_url: str) -> str:
+    """File-safe key from the avatar path, which already contains the avatar hash.
+
+    e.g. .../avatars/<user_id>/<hash>.png?size=1024 -> avatars_<user_id>_<hash>;
+    a new avatar gets a new hash, so stale tiles are never reused.
+    """
+    path = os.path.splitext(urlparse(avatar_url).path)[0]
+    return re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "default"
+
+
+def card_cache_key(card: CardData, avatar_key: str, output_format: str = "png") -> str:
+    """Content address of a card: any changed input gives a new key, so nothing needs invalidating"""
+    payload = json.dumps([asdict(card), avatar_key, output_format], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def encode_card(img: Image.Image, encoder: CardEncoder) -> bytes:
+    if encoder.scale != 1.0:
+        size = (int(img.width * encoder.scale), int(img.height * encoder.scale))
+        img = img.resize(size, Image.Resampling.BILINEAR)
+    if encoder.palette:
+        img = img.quantize(256, method=Image.Quantize.FASTOCTREE)
+    output = io.BytesIO()
+    img.save(output, format=encoder.format, **encoder.options)
+    return output.getvalue()
+
+
+@dataclass
+class EncoderStats:
+    """Moving averages for one encoder, fed by every render"""
+    samples: int = 0
+    encode_ms: float = 0.0
+    size_bytes: float = 0.0
+    
+    def observe(self, encode_ms: float, size_bytes: int, alpha: float = 0.2):
+        if self.samples == 0:
+            self.encode_ms, self.size_bytes = encode_ms, float(size_bytes)
+        else:
+            self.encode_ms += alpha * (encode_ms - self.encode_ms)
+            self.size_bytes += alpha * (size_bytes - self.size_bytes)
+        self.samples += 1
+    
+    def cost_ms(self) -> float:
+        """Encode time + estimated upload time"""
+        return self.encode_ms + self.size_bytes / (CARD_UPLOAD_KBPS * 1.024)
+
+
+def _lerp_color(start: tuple, end: tuple, ratio: float) -> tuple:
+    return tuple(int(a + (b - a) * ratio) for a, b in zip(start, end))
+
 
 class ProfileCard:
     def __init__(self):
@@ -32,135 +200,221 @@ class ProfileCard:
             self.font_small = ImageFont.load_default()
             self.font_tiny = ImageFont.load_default()
             self.font_bold = ImageFont.load_default()
+        
+        # Gradient + dotted overlay per tier, built once and copied per card
+        self._backgrounds: Dict[str, Image.Image] = {}
+        # Background + every static layer per tier (see get_template)
+        self._templates: Dict[str, Image.Image] = {}
+        self._avatar_borders: Dict[str, Image.Image] = {}
+        self._corner_masks: Dict[tuple, Image.Image] = {}
+        
+        # Circular avatar mask
+        self._avatar_mask = Image.new('L', (AVATAR_SIZE, AVATAR_SIZE), 0)
+        ImageDraw.Draw(self._avatar_mask).ellipse((0, 0, AVATAR_SIZE, AVATAR_SIZE), fill=255)
+        
+        # Render pool (created on first use) + bounded queue in front of it
+        self.render_workers = CARD_RENDER_WORKERS
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._render_slots = asyncio.Semaphore(CARD_RENDER_QUEUE)
+        
+        # Shared HTTP session + avatar tile cache (memory LRU, then profile_cache/)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._avatar_tiles: "OrderedDict[str, bytes]" = OrderedDict()
+        self._disk_writes = 0
+        self.avatar_hits = 0
+        self.avatar_disk_hits = 0
+        self.avatar_misses = 0
+        
+        # Encoded card output cache (see card_cache_key)
+        self.card_cache_limit = int(CARD_CACHE_MB * 1024 * 1024)
+        self._cards: "OrderedDict[str, Tuple[str, bytes]]" = OrderedDict()
+        self._cards_bytes = 0
+        self.card_hits = 0
+        self.card_misses = 0
+        
+        # Measured cost per encoder, used by the "auto" format
+        self.encoder_stats: Dict[str, EncoderStats] = {name: EncoderStats() for name in CARD_ENCODERS}
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        """Avatar session, reused across cards and reopened after close()"""
+        if self._session is None or self._session.closed:
+            self._session = create_pooled_session(10, timeout=AVATAR_DOWNLOAD_TIMEOUT)
+        return self._session
     
-    async def download_avatar(self, avatar_url: str) -> Optional[Image.Image]:
-        """Download and cache user avatar"""
+    async def download_avatar(self, avatar_url: str) -> Optional[bytes]:
+        """Download raw avatar bytes (decoded later, off the event loop)"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(avatar_url) as resp:
-                    if resp.status == 200:
-                        data = await resp.read()
-                        return Image.open(io.BytesIO(data)).convert("RGBA")
+            async with self.get_session().get(avatar_url) as resp:
+                if resp.status == 200:
+                    return await resp.read()
         except Exception as e:
             print(f"Error downloading avatar: {e}")
+        return None
+    
+    def make_avatar_tile(self, avatar_data: bytes) -> bytes:
+        """Decode, resize and circle-mask an avatar; returns raw 180x180 RGBA bytes"""
+        avatar = Image.open(io.BytesIO(avatar_data)).convert("RGBA")
+        avatar = avatar.resize((AVATAR_SIZE, AVATAR_SIZE), Image.Resampling.LANCZOS)
+        
+        tile = Image.new('RGBA', avatar.size, (0, 0, 0, 0))
+        tile.paste(avatar, (0, 0))
+        tile.putalpha(self._avatar_mask)
+        return tile.tobytes()
+    
+    def _remember_tile(self, key: str, tile: bytes):
+        self._avatar_tiles[key] = tile
+        self._avatar_tiles.move_to_end(key)
+        while len(self._avatar_tiles) > AVATAR_MEMORY_TILES:
+            self._avatar_tiles.popitem(last=False)
+    
+    def _tile_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+    
+    def _load_tile_file(self, key: str) -> Optional[bytes]:
+        try:
+            with Image.open(self._tile_path(key)) as tile:
+                if tile.size != (AVATAR_SIZE, AVATAR_SIZE):
+                    return None
+                return tile.convert("RGBA").tobytes()
+        except (OSError, ValueError):
             return None
     
-    def create_gradient_background(self, color1: tuple, color2: tuple, color3: tuple = None) -> Image.Image:
-        """Create smooth gradient background with optional 3-color gradient"""
-        base = Image.new('RGB', (self.width, self.height), color1)
-        draw = ImageDraw.Draw(base)
+    def _save_tile_file(self, key: str, tile: bytes, prune: bool):
+        try:
+            Image.frombytes("RGBA", (AVATAR_SIZE, AVATAR_SIZE), tile).save(self._tile_path(key), format="PNG")
+            if prune:
+                paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+                if len(paths) > AVATAR_DISK_TILES:
+                    paths.sort(key=os.path.getmtime)
+                    for old in paths[:len(paths) - AVATAR_DISK_TILES]:
+                        os.remove(old)
+        except OSError as e:
+            print(f"Error caching avatar: {e}")
+    
+    def _remember_card(self, key: str, ext: str, data: bytes):
+        if len(data) > self.card_cache_limit:
+            return
+        old = self._cards.pop(key, None)
+        if old is not None:
+            self._cards_bytes -= len(old[1])
+        self._cards[key] = (ext, data)
+        self._cards_bytes += len(data)
+        while self._cards_bytes > self.card_cache_limit:
+            _, (_, evicted) = self._cards.popitem(last=False)
+            self._cards_bytes -= len(evicted)
+    
+    def choose_encoder(self, output_format: Optional[str] = None) -> str:
+        """Resolve a format name; "auto" tries each candidate a few times, then keeps the cheapest"""
+        name = (output_format or CARD_FORMAT).lower()
+        if name in CARD_ENCODERS:
+            return name
+        untested = [n for n in AUTO_ENCODERS if self.encoder_stats[n].samples < AUTO_MIN_SAMPLES]
+        if untested:
+            return min(untested, key=lambda n: self.encoder_stats[n].samples)
+        return min(AUTO_ENCODERS, key=lambda n: self.encoder_stats[n].cost_ms())
+    
+    async def get_avatar_tile(self, avatar_url: str) -> Optional[bytes]:
+        """Avatar tile for a URL: memory -> disk -> download + decode in the pool"""
+        key = avatar_cache_key(avatar_url)
+        tile = self._avatar_tiles.get(key)
+        if tile is not None:
+            self._avatar_tiles.move_to_end(key)
+            self.avatar_hits += 1
+            return tile
+        
+        tile = await asyncio.to_thread(self._load_tile_file, key)
+        if tile is not None:
+            self.avatar_disk_hits += 1
+            self._remember_tile(key, tile)
+            return tile
+        
+        self.avatar_misses += 1
+        avatar_data = await self.download_avatar(avatar_url)
+        if not avatar_data:
+            return None
+        try:
+            tile = await self._run_in_pool(make_avatar_tile, self.make_avatar_tile, avatar_data)
+        except CardQueueFull:
+            raise
+        except Exception as e:
+            print(f"Error decoding avatar: {e}")
+            return None
         
+        self._remember_tile(key, tile)
+        # Prune the disk tier every 50 writes instead of listing the folder each time
+        self._disk_writes += 1
+        await asyncio.to_thread(self._save_tile_file, key, tile, self._disk_writes % 50 == 0)
+        return tile
+    
+    def create_gradient_background(self, color1: tuple, color2: tuple, color3: tuple = None) -> Image.Image:
+        """Create smooth gradient background with optional 3-color gradient.
+
+        Builds a 1px-wide column of row colors and stretches it, instead of
+        drawing one line per row.
+        """
         if color3:
             # 3-color gradient
             mid_point = self.height // 2
-            for i in range(mid_point):
-                r = int(color1[0] + (color2[0] - color1[0]) * i / mid_point)
-                g = int(color1[1] + (color2[1] - color1[1]) * i / mid_point)
-                b = int(color1[2] + (color2[2] - color1[2]) * i / mid_point)
-                draw.line([(0, i), (self.width, i)], fill=(r, g, b))
-            for i in range(mid_point, self.height):
-                r = int(color2[0] + (color3[0] - color2[0]) * (i - mid_point) / mid_point)
-                g = int(color2[1] + (color3[1] - color2[1]) * (i - mid_point) / mid_point)
-                b = int(color2[2] + (color3[2] - color2[2]) * (i - mid_point) / mid_point)
-                draw.line([(0, i), (self.width, i)], fill=(r, g, b))
+            rows = [_lerp_color(color1, color2, i / mid_point) for i in range(mid_point)]
+            rows += [
+                _lerp_color(color2, color3, (i - mid_point) / mid_point)
+                for i in range(mid_point, self.height)
+            ]
         else:
             # 2-color gradient
-            for i in range(self.height):
-                r = int(color1[0] + (color2[0] - color1[0]) * i / self.height)
-                g = int(color1[1] + (color2[1] - color1[1]) * i / self.height)
-                b = int(color1[2] + (color2[2] - color1[2]) * i / self.height)
-                draw.line([(0, i), (self.width, i)], fill=(r, g, b))
+            rows = [_lerp_color(color1, color2, i / self.height) for i in range(self.height)]
         
-        return base
+        strip = Image.new('RGB', (1, self.height))
+        strip.putdata(rows)
+        return strip.resize((self.width, self.height), Image.Resampling.NEAREST)
+    
+    def create_horizontal_gradient(self, color1: tuple, color2: tuple, width: int, height: int) -> Image.Image:
+        """Left-to-right gradient built from a 1px-tall row"""
+        strip = Image.new('RGB', (width, 1))
+        strip.putdata([_lerp_color(color1, color2, i / width) for i in range(width)])
+        return strip.resize((width, height), Image.Resampling.NEAREST)
+    
+    def get_background(self, tier: str) -> Image.Image:
+        """Cached tier background (gradient + decorative circles); callers must copy it"""
+        background = self._backgrounds.get(tier)
+        if background is None:
+            color1, color2, color3, _ = TIER_COLORS[tier]
+            gradient = self.create_gradient_background(color1, color2, color3)
+            
+            # Add decorative overlay pattern (subtle circles)
+            overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
+            overlay_draw = ImageDraw.Draw(overlay)
+            for i in range(0, self.width, 100):
+                for j in range(0, self.height, 100):
+                    overlay_draw.ellipse(
+                        [(i-20, j-20), (i+20, j+20)],
+                        fill=(255, 255, 255, 10)
+                    )
+            
+            background = Image.alpha_composite(gradient.convert('RGBA'), overlay).convert('RGB')
+            self._backgrounds[tier] = background
+        return background
     
     def add_rounded_corners(self, img: Image.Image, radius: int) -> Image.Image:
-        """Add rounded corners to image"""
-        mask = Image.new('L', img.size, 0)
-        draw = ImageDraw.Draw(mask)
-        draw.rounded_rectangle([(0, 0), img.size], radius, fill=255)
+        """Add rounded corners to image (the mask is built once per size/radius)"""
+        key = (img.size, radius)
+        mask = self._corner_masks.get(key)
+        if mask is None:
+            mask = Image.new('L', img.size, 0)
+            draw = ImageDraw.Draw(mask)
+            draw.rounded_rectangle([(0, 0), img.size], radius, fill=255)
+            self._corner_masks[key] = mask
         
-        result = Image.new('RGBA', img.size)
-        result.paste(img, (0, 0))
+        result = img.convert('RGBA')
         result.putalpha(mask)
         return result
     
-    async def generate_profile_card(
-        self,
-        username: str,
-        avatar_url: str,
-        level: int,
-        xp: int,
-        xp_needed: int,
-        balance: int,
-        bank: int,
-        streak: int,
-        wins: int,
-        losses: int,
-        is_infinity: bool = False,
-        equipped_ring: str = None,
-        equipped_pet: str = None,
-        partner_name: str = None
-    ) -> io.BytesIO:
-        """Generate profile card image"""
-        
-        # Choose color scheme based on level (OWO-inspired)
-        if is_infinity:
-            color1 = (255, 223, 0)   # Bright gold
-            color2 = (255, 165, 0)   # Orange
-            color3 = (255, 69, 0)    # Red-orange
-            accent_color = (255, 255, 255)
-            badge_color = (255, 215, 0)
-        elif level >= 50:
-            color1 = (147, 51, 234)  # Purple
-            color2 = (126, 34, 206)  # Dark purple
-            color3 = (75, 0, 130)    # Indigo
-            accent_color = (255, 255, 255)
-            badge_color = (147, 51, 234)
-        elif level >= 25:
-            color1 = (59, 130, 246)  # Blue
-            color2 = (37, 99, 235)   # Dark blue
-            color3 = (29, 78, 216)   # Darker blue
-            accent_color = (255, 255, 255)
-            badge_color = (59, 130, 246)
-        else:
-            color1 = (34, 197, 94)   # Green
-            color2 = (22, 163, 74)   # Dark green
-            color3 = (21, 128, 61)   # Darker green
-            accent_color = (255, 255, 255)
-            badge_color = (34, 197, 94)
-        
-        # Create base with 3-color gradient
-        img = self.create_gradient_background(color1, color2, color3)
-        draw = ImageDraw.Draw(img)
-        
-        # Add decorative overlay pattern
-        overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
-        
-        # Add subtle circles pattern
-        for i in range(0, self.width, 100):
-            for j in range(0, self.height, 100):
-                overlay_draw.ellipse(
-                    [(i-20, j-20), (i+20, j+20)],
-                    fill=(255, 255, 255, 10)
-                )
-        
-        img = Image.alpha_composite(img.convert('RGBA'), overlay).convert('RGB')
-        
-        # Download and add avatar with fancy border
-        avatar = await self.download_avatar(avatar_url)
-        if avatar:
-            # Resize avatar (larger)
-            avatar_size = 180
-            avatar = avatar.resize((avatar_size, avatar_size), Image.Resampling.LANCZOS)
-            
-            # Create circular mask
-            mask = Image.new('L', (avatar_size, avatar_size), 0)
-            mask_draw = ImageDraw.Draw(mask)
-            mask_draw.ellipse((0, 0, avatar_size, avatar_size), fill=255)
-            
-            # Add gradient border (thicker)
-            border_size = avatar_size + 16
+    def get_avatar_border(self, tier: str) -> Image.Image:
+        """Cached multi-layer ring drawn around the avatar"""
+        border = self._avatar_borders.get(tier)
+        if border is None:
+            badge_color = TIER_COLORS[tier][3]
+            border_size = AVATAR_SIZE + 16
             border = Image.new('RGBA', (border_size, border_size), (0, 0, 0, 0))
             border_draw = ImageDraw.Draw(border)
             
@@ -172,94 +426,127 @@ class ProfileCard:
                     outline=(*badge_color, alpha),
                     width=2
                 )
+            self._avatar_borders[tier] = border
+        return border
+    
+    def get_template(self, tier: str) -> Image.Image:
+        """Every layer that only depends on the tier, rendered once; callers must copy it"""
+        template = self._templates.get(tier)
+        if template is not None:
+            return template
+        
+        template = self.get_background(tier).copy()
+        draw = ImageDraw.Draw(template)
+        
+        # Level badge background + "LEVEL" label
+        draw.rounded_rectangle(
+            [(LEVEL_BADGE_X, LEVEL_BADGE_Y), (LEVEL_BADGE_X + LEVEL_BADGE_WIDTH, LEVEL_BADGE_Y + LEVEL_BADGE_HEIGHT)],
+            radius=15,
+            fill=(0, 0, 0, 100)
+        )
+        draw.text((LEVEL_BADGE_X + 10, LEVEL_BADGE_Y - 25), "LEVEL", fill=(255, 255, 255, 200), font=self.font_tiny)
+        
+        # XP bar track (infinity cards have no bar)
+        if tier != "infinity":
+            draw.rounded_rectangle(
+                [(BAR_X+2, BAR_Y+2), (BAR_X + BAR_WIDTH+2, BAR_Y + BAR_HEIGHT+2)],
+                radius=15,
+                fill=(0, 0, 0, 80)
+            )
+            draw.rounded_rectangle(
+                [(BAR_X, BAR_Y), (BAR_X + BAR_WIDTH, BAR_Y + BAR_HEIGHT)],
+                radius=15,
+                fill=(40, 40, 40, 255)
+            )
+        
+        # Stat card backgrounds, icons and labels
+        for x, width, icon, label, color in STAT_CARDS:
+            draw.rounded_rectangle(
+                [(x, STATS_Y), (x + width, STATS_Y + 70)],
+                radius=12,
+                fill=(0, 0, 0, 120)
+            )
+            draw.text((x + 10, STATS_Y + 8), icon, fill=color, font=self.font_medium)
+            draw.text((x + 50, STATS_Y + 10), label, fill=(200, 200, 200), font=self.font_tiny)
+        
+        # Special badges
+        badge_x = 820
+        badge_y = 20
+        if tier == "infinity":
+            # Infinity badge with glow
+            draw.text((badge_x+2, badge_y+2), "♾️", fill=(0, 0, 0, 100), font=self.font_xlarge)
+            draw.text((badge_x, badge_y), "♾️", fill=(255, 215, 0), font=self.font_xlarge)
+            draw.text((badge_x-15, badge_y+60), "INFINITY", fill=(255, 215, 0), font=self.font_tiny)
+        elif tier == "legend":
+            draw.text((badge_x, badge_y), "👑", fill=(255, 215, 0), font=self.font_xlarge)
+            draw.text((badge_x-5, badge_y+60), "LEGEND", fill=(255, 215, 0), font=self.font_tiny)
+        elif tier == "veteran":
+            draw.text((badge_x, badge_y), "⭐", fill=(255, 255, 255), font=self.font_xlarge)
+            draw.text((badge_x-10, badge_y+60), "VETERAN", fill=(255, 255, 255), font=self.font_tiny)
+        
+        # Footer text
+        draw.text((40, 420), "Doro Bot Profile Card • Use +about for item info", fill=(200, 200, 200, 150), font=self.font_tiny)
+        draw.text((750, 420), "v2.1", fill=(200, 200, 200, 150), font=self.font_tiny)
+        
+        self._templates[tier] = template
+        return template
+    
+    def compose(self, card: CardData, avatar_tile: Optional[bytes] = None) -> Image.Image:
+        """Draw one card (RGBA, rounded): copy the tier template and draw only the per-user parts"""
+        
+        # Choose color scheme based on level (OWO-inspired)
+        tier = card_tier(card.level, card.is_infinity)
+        badge_color = TIER_COLORS[tier][3]
+        accent_color = (255, 255, 255)
+        
+        img = self.get_template(tier).copy()
+        
+        # Add avatar (pre-masked tile, see make_avatar_tile) with fancy border
+        if avatar_tile:
+            border = self.get_avatar_border(tier)
+            img.paste(border, (30, 30), border)
             
-            # Paste avatar with border
-            img_rgba = img.convert('RGBA')
-            img_rgba.paste(border, (30, 30), border)
-            
-            output = Image.new('RGBA', avatar.size, (0, 0, 0, 0))
-            output.paste(avatar, (0, 0))
-            output.putalpha(mask)
-            img_rgba.paste(output, (38, 38), output)
-            img = img_rgba.convert('RGB')
+            avatar = Image.frombytes('RGBA', (AVATAR_SIZE, AVATAR_SIZE), avatar_tile)
+            img.paste(avatar, (38, 38), avatar)
         
-        # Create new draw object for RGB image
         draw = ImageDraw.Draw(img)
         
         # Username with shadow effect
         shadow_offset = 3
-        draw.text((243+shadow_offset, 43+shadow_offset), username, fill=(0, 0, 0, 128), font=self.font_xlarge)
-        draw.text((243, 43), username, fill=accent_color, font=self.font_xlarge)
+        draw.text((243+shadow_offset, 43+shadow_offset), card.username, fill=(0, 0, 0, 128), font=self.font_xlarge)
+        draw.text((243, 43), card.username, fill=accent_color, font=self.font_xlarge)
         
-        # Level badge (rounded rectangle)
-        level_badge_x = 243
-        level_badge_y = 110
-        if is_infinity:
+        if card.is_infinity:
             level_text = "∞"
             xp_text = "MAX LEVEL"
         else:
-            level_text = str(level)
-            xp_text = f"{xp:,} / {xp_needed:,} XP"
-        
-        # Draw level badge background
-        badge_width = 120
-        badge_height = 50
-        draw.rounded_rectangle(
-            [(level_badge_x, level_badge_y), (level_badge_x + badge_width, level_badge_y + badge_height)],
-            radius=15,
-            fill=(0, 0, 0, 100)
-        )
+            level_text = str(card.level)
+            xp_text = f"{card.xp:,} / {card.xp_needed:,} XP"
         
         # Level number (centered in badge)
         level_bbox = draw.textbbox((0, 0), level_text, font=self.font_large)
         level_width = level_bbox[2] - level_bbox[0]
-        level_x = level_badge_x + (badge_width - level_width) // 2
-        draw.text((level_x, level_badge_y + 5), level_text, fill=badge_color, font=self.font_large)
-        
-        # "LEVEL" label
-        draw.text((level_badge_x + 10, level_badge_y - 25), "LEVEL", fill=(255, 255, 255, 200), font=self.font_tiny)
+        level_x = LEVEL_BADGE_X + (LEVEL_BADGE_WIDTH - level_width) // 2
+        draw.text((level_x, LEVEL_BADGE_Y + 5), level_text, fill=badge_color, font=self.font_large)
         
         # XP text
         draw.text((243, 175), xp_text, fill=accent_color, font=self.font_small)
         
-        # XP Progress bar (if not infinity) - Modern design
-        if not is_infinity:
-            bar_x = 243
-            bar_y = 210
-            bar_width = 620
-            bar_height = 30
-            
-            # Background bar with shadow
-            draw.rounded_rectangle(
-                [(bar_x+2, bar_y+2), (bar_x + bar_width+2, bar_y + bar_height+2)],
-                radius=15,
-                fill=(0, 0, 0, 80)
-            )
-            draw.rounded_rectangle(
-                [(bar_x, bar_y), (bar_x + bar_width, bar_y + bar_height)],
-                radius=15,
-                fill=(40, 40, 40, 255)
-            )
-            
-            # Progress bar with gradient effect
-            progress = min(xp / xp_needed, 1.0)
-            progress_width = int(bar_width * progress)
+        # XP progress fill (the bar track is part of the template)
+        if not card.is_infinity:
+            progress = min(card.xp / card.xp_needed, 1.0)
+            progress_width = int(BAR_WIDTH * progress)
             if progress_width > 0:
-                # Create gradient for progress bar
-                for i in range(progress_width):
-                    alpha = 255
-                    ratio = i / progress_width
-                    r = int(badge_color[0] + (255 - badge_color[0]) * ratio * 0.3)
-                    g = int(badge_color[1] + (255 - badge_color[1]) * ratio * 0.3)
-                    b = int(badge_color[2] + (255 - badge_color[2]) * ratio * 0.3)
-                    draw.line(
-                        [(bar_x + i, bar_y), (bar_x + i, bar_y + bar_height)],
-                        fill=(r, g, b, alpha)
-                    )
+                # Gradient for progress bar: badge color fading 30% towards white
+                bar_end = tuple(c + (255 - c) * 0.3 for c in badge_color)
+                img.paste(
+                    self.create_horizontal_gradient(badge_color, bar_end, progress_width, BAR_HEIGHT + 1),
+                    (BAR_X, BAR_Y)
+                )
                 
                 # Add shine effect
                 draw.rounded_rectangle(
-                    [(bar_x, bar_y), (bar_x + progress_width, bar_y + bar_height)],
+                    [(BAR_X, BAR_Y), (BAR_X + progress_width, BAR_Y + BAR_HEIGHT)],
                     radius=15,
                     outline=(255, 255, 255, 100),
                     width=2
@@ -270,69 +557,32 @@ class ProfileCard:
             pct_bbox = draw.textbbox((0, 0), progress_pct, font=self.font_small)
             pct_width = pct_bbox[2] - pct_bbox[0]
             draw.text(
-                (bar_x + bar_width - pct_width - 10, bar_y + 3),
+                (BAR_X + BAR_WIDTH - pct_width - 10, BAR_Y + 3),
                 progress_pct,
                 fill=(255, 255, 255),
                 font=self.font_small
             )
         
-        # Stats section with cards
-        stats_y = 270
-        
-        # Create stat cards
-        def draw_stat_card(x, y, width, height, icon, label, value, color):
-            # Card background
-            draw.rounded_rectangle(
-                [(x, y), (x + width, y + height)],
-                radius=12,
-                fill=(0, 0, 0, 120)
-            )
-            # Icon/Emoji
-            draw.text((x + 10, y + 8), icon, fill=color, font=self.font_medium)
-            # Label
-            draw.text((x + 50, y + 10), label, fill=(200, 200, 200), font=self.font_tiny)
-            # Value
-            draw.text((x + 50, y + 30), value, fill=accent_color, font=self.font_small)
-        
-        # Balance card
-        if is_infinity:
+        # Stat values (card backgrounds, icons and labels are in the template)
+        if card.is_infinity:
             balance_val = "∞"
             bank_val = "∞"
         else:
-            balance_val = f"{balance:,}"
-            bank_val = f"{bank:,}"
+            balance_val = f"{card.balance:,}"
+            bank_val = f"{card.bank:,}"
         
-        draw_stat_card(40, stats_y, 200, 70, "💰", "WALLET", balance_val, (255, 215, 0))
-        draw_stat_card(260, stats_y, 200, 70, "🏦", "BANK", bank_val, (100, 149, 237))
-        draw_stat_card(480, stats_y, 200, 70, "🔥", "STREAK", f"{streak} days", (255, 69, 0))
-        
-        # Win/Loss stats card
-        total_games = wins + losses
-        win_rate = (wins / total_games * 100) if total_games > 0 else 0
-        draw_stat_card(700, stats_y, 170, 70, "🎮", "WIN RATE", f"{win_rate:.1f}%", (50, 205, 50))
+        total_games = card.wins + card.losses
+        win_rate = (card.wins / total_games * 100) if total_games > 0 else 0
+        values = [balance_val, bank_val, f"{card.streak} days", f"{win_rate:.1f}%"]
+        for (x, _, _, _, _), value in zip(STAT_CARDS, values):
+            draw.text((x + 50, STATS_Y + 30), value, fill=accent_color, font=self.font_small)
         
         # Win/Loss details
-        draw.text((710, stats_y + 50), f"W:{wins} L:{losses}", fill=(180, 180, 180), font=self.font_tiny)
-        
-        # Special badges
-        badge_x = 820
-        badge_y = 20
-        
-        if is_infinity:
-            # Infinity badge with glow
-            draw.text((badge_x+2, badge_y+2), "♾️", fill=(0, 0, 0, 100), font=self.font_xlarge)
-            draw.text((badge_x, badge_y), "♾️", fill=(255, 215, 0), font=self.font_xlarge)
-            draw.text((badge_x-15, badge_y+60), "INFINITY", fill=(255, 215, 0), font=self.font_tiny)
-        elif level >= 50:
-            draw.text((badge_x, badge_y), "👑", fill=(255, 215, 0), font=self.font_xlarge)
-            draw.text((badge_x-5, badge_y+60), "LEGEND", fill=(255, 215, 0), font=self.font_tiny)
-        elif level >= 25:
-            draw.text((badge_x, badge_y), "⭐", fill=(255, 255, 255), font=self.font_xlarge)
-            draw.text((badge_x-10, badge_y+60), "VETERAN", fill=(255, 255, 255), font=self.font_tiny)
+        draw.text((710, STATS_Y + 50), f"W:{card.wins} L:{card.losses}", fill=(180, 180, 180), font=self.font_tiny)
         
         # Equipped items section
         equip_y = 360
-        if equipped_ring or equipped_pet or partner_name:
+        if card.equipped_ring or card.equipped_pet or card.partner_name:
             # Draw equipped items card
             draw.rounded_rectangle(
                 [(40, equip_y), (870, equip_y + 40)],
@@ -341,28 +591,246 @@ class ProfileCard:
             )
             
             equip_x = 50
-            if partner_name:
-                draw.text((equip_x, equip_y + 10), f"💑 {partner_name}", fill=(255, 182, 193), font=self.font_small)
+            if card.partner_name:
+                draw.text((equip_x, equip_y + 10), f"💑 {card.partner_name}", fill=(255, 182, 193), font=self.font_small)
                 equip_x += 250
-            if equipped_ring:
-                draw.text((equip_x, equip_y + 10), f"💍 {equipped_ring}", fill=(255, 215, 0), font=self.font_small)
+            if card.equipped_ring:
+                draw.text((equip_x, equip_y + 10), f"💍 {card.equipped_ring}", fill=(255, 215, 0), font=self.font_small)
                 equip_x += 250
-            if equipped_pet:
-                draw.text((equip_x, equip_y + 10), f"🐾 {equipped_pet}", fill=(100, 200, 255), font=self.font_small)
-        
-        # Footer text
-        draw.text((40, 420), "Doro Bot Profile Card • Use +about for item info", fill=(200, 200, 200, 150), font=self.font_tiny)
-        draw.text((750, 420), "v2.1", fill=(200, 200, 200, 150), font=self.font_tiny)
+            if card.equipped_pet:
+                draw.text((equip_x, equip_y + 10), f"🐾 {card.equipped_pet}", fill=(100, 200, 255), font=self.font_small)
         
         # Add rounded corners
-        img = self.add_rounded_corners(img, 20)
+        return self.add_rounded_corners(img, 20)
+    
+    def render(self, card: CardData, avatar_tile: Optional[bytes] = None, encoder: str = "png") -> Tuple[bytes, float]:
+        """Compose and encode a card; returns (encoded bytes, encode time in ms)"""
+        img = self.compose(card, avatar_tile)
+        started = time.perf_counter()
+        data = encode_card(img, CARD_ENCODERS[encoder])
+        return data, (time.perf_counter() - started) * 1000
+    
+    def render_gallery(
+        self,
+        cards: List[CardData],
+        avatar_tiles: List[Optional[bytes]],
+        encoder: str = "png",
+        columns: int = GALLERY_COLUMNS,
+    ) -> Tuple[bytes, float]:
+        """Compose many cards into one half-scale grid and encode it once"""
+        cell_w, cell_h = self.width // 2, self.height // 2
+        rows = (len(cards) + columns - 1) // columns
+        gallery = Image.new(
+            'RGBA',
+            (columns * cell_w + (columns - 1) * GALLERY_GAP, rows * cell_h + (rows - 1) * GALLERY_GAP),
+            (0, 0, 0, 0)
+        )
+        for index, (card, tile) in enumerate(zip(cards, avatar_tiles)):
+            row, col = divmod(index, columns)
+            thumb = self.compose(card, tile).reduce(2)
+            gallery.paste(thumb, (col * (cell_w + GALLERY_GAP), row * (cell_h + GALLERY_GAP)))
         
-        # Save to BytesIO
-        output = io.BytesIO()
-        img.save(output, format='PNG')
-        output.seek(0)
+        started = time.perf_counter()
+        data = encode_card(gallery, CARD_ENCODERS[encoder])
+        return data, (time.perf_counter() - started) * 1000
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: forking a bot that already runs threads (aiohttp, yt-dlp pool) is unsafe.
+            # Spawned workers re-import the main module and this one, so both must stay
+            # free of import-time work: main.py only runs the bot inside main(), and the
+            # pool entry points below only need PIL/aiohttp (never storage or lenh).
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.render_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+    
+    async def _run_in_pool(self, pool_fn, local_fn, *args):
+        """Run pool_fn in a worker process (local_fn in a thread when workers=0).
+
+        Waits for a queue slot first, so a burst of cards applies backpressure
+        instead of piling up unbounded work.
+        """
+        try:
+            await asyncio.wait_for(self._render_slots.acquire(), timeout=CARD_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise CardQueueFull("profile card render queue is full") from None
         
+        try:
+            if self.render_workers <= 0:
+                return await asyncio.to_thread(local_fn, *args)
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._get_executor(), pool_fn, *args)
+            except BrokenProcessPool:
+                # A worker died (OOM/kill) - start a fresh pool for the next card
+                self._executor = None
+                raise
+        finally:
+            self._render_slots.release()
+    
+    async def render_async(self, card: CardData, avatar_tile: Optional[bytes] = None, encoder: str = "png") -> bytes:
+        """Render off the event loop and feed the encoder's measurements"""
+        data, encode_ms = await self._run_in_pool(render_profile_card, self.render, card, avatar_tile, encoder)
+        self.encoder_stats[encoder].observe(encode_ms, len(data))
+        return data
+    
+    async def generate_profile_card(
+        self,
+        username: str,
+        avatar_url: str,
+        level: int,
+        xp: int,
+        xp_needed: int,
+        balance: int,
+        bank: int,
+        streak: int,
+        wins: int,
+        losses: int,
+        is_infinity: bool = False,
+        equipped_ring: str = None,
+        equipped_pet: str = None,
+        partner_name: str = None,
+        output_format: Optional[str] = None
+    ) -> io.BytesIO:
+        """Generate profile card image (cached output, else avatar tile + render in the pool).
+
+        output_format is a CARD_ENCODERS name or "auto" (default: CARD_FORMAT). The
+        returned buffer's .name ("profile.png"/"profile.webp") carries the extension.
+        """
+        card = CardData(
+            username=username,
+            level=level,
+            xp=xp,
+            xp_needed=xp_needed,
+            balance=balance,
+            bank=bank,
+            streak=streak,
+            wins=wins,
+            losses=losses,
+            is_infinity=is_infinity,
+            equipped_ring=equipped_ring,
+            equipped_pet=equipped_pet,
+            partner_name=partner_name,
+        )
+        requested = (output_format or CARD_FORMAT).lower()
+        key = card_cache_key(card, avatar_cache_key(avatar_url), requested)
+        cached = self._cards.get(key)
+        if cached is not None:
+            self._cards.move_to_end(key)
+            self.card_hits += 1
+            ext, data = cached
+        else:
+            self.card_misses += 1
+            encoder = self.choose_encoder(requested)
+            ext = CARD_ENCODERS[encoder].ext
+            avatar_tile = await self.get_avatar_tile(avatar_url)
+            data = await self.render_async(card, avatar_tile, encoder)
+            # A card rendered without its avatar (download failed) should be retried next time
+            if avatar_tile is not None:
+                self._remember_card(key, ext, data)
+        
+        output = io.BytesIO(data)
+        output.name = f"profile.{ext}"
+        return output
+    
+    async def generate_gallery(self, entries: List[Dict], output_format: Optional[str] = None) -> io.BytesIO:
+        """Render several cards (e.g. a top-10 leaderboard) into one image.
+
+        Each entry holds generate_profile_card's arguments. Avatars are fetched
+        in parallel through the tile cache, then one pool job composes every card
+        on the shared templates and encodes the grid once.
+        """
+        cards = [CardData(**{k: v for k, v in entry.items() if k != "avatar_url"}) for entry in entries]
+        avatar_urls = [entry["avatar_url"] for entry in entries]
+        requested = (output_format or CARD_FORMAT).lower()
+        # A gallery is addressed by its cards' addresses (in order) + format
+        card_keys = [card_cache_key(card, avatar_cache_key(url)) for card, url in zip(cards, avatar_urls)]
+        key = hashlib.blake2b(
+            "|".join(["gallery", requested, *card_keys]).encode("utf-8"), digest_size=16
+        ).hexdigest()
+        
+        cached = self._cards.get(key)
+        if cached is not None:
+            self._cards.move_to_end(key)
+            self.card_hits += 1
+            ext, data = cached
+        else:
+            self.card_misses += 1
+            encoder = self.choose_encoder(requested)
+            ext = CARD_ENCODERS[encoder].ext
+            unique_urls = list(dict.fromkeys(avatar_urls))
+            fetched = await asyncio.gather(*(self.get_avatar_tile(url) for url in unique_urls))
+            tiles_by_url = dict(zip(unique_urls, fetched))
+            avatar_tiles = [tiles_by_url[url] for url in avatar_urls]
+            data, _ = await self._run_in_pool(
+                render_profile_gallery, self.render_gallery, cards, avatar_tiles, encoder
+            )
+            if all(tile is not None for tile in avatar_tiles):
+                self._remember_card(key, ext, data)
+        
+        output = io.BytesIO(data)
+        output.name = f"gallery.{ext}"
         return output
+    
+    def avatar_stats(self) -> Dict:
+        lookups = self.avatar_hits + self.avatar_disk_hits + self.avatar_misses
+        return {
+            "memory_tiles": len(self._avatar_tiles),
+            "hits": self.avatar_hits,
+            "disk_hits": self.avatar_disk_hits,
+            "misses": self.avatar_misses,
+            "hit_rate": ((self.avatar_hits + self.avatar_disk_hits) / lookups * 100) if lookups else 0.0,
+        }
+    
+    def card_stats(self) -> Dict:
+        lookups = self.card_hits + self.card_misses
+        return {
+            "cards": len(self._cards),
+            "bytes": self._cards_bytes,
+            "limit": self.card_cache_limit,
+            "hits": self.card_hits,
+            "misses": self.card_misses,
+            "hit_rate": (self.card_hits / lookups * 100) if lookups else 0.0,
+        }
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self.shutdown()
+
+
+# Renderer owned by a worker process (templates stay cached between cards)
+_worker_card: Optional[ProfileCard] = None
+
+
+def _get_worker_card() -> ProfileCard:
+    global _worker_card
+    if _worker_card is None:
+        _worker_card = ProfileCard()
+    return _worker_card
+
+
+def render_profile_card(card: CardData, avatar_tile: Optional[bytes] = None, encoder: str = "png") -> Tuple[bytes, float]:
+    """Process-pool entry point: plain data in, (encoded bytes, encode ms) out"""
+    return _get_worker_card().render(card, avatar_tile, encoder)
+
+
+def render_profile_gallery(cards: List[CardData], avatar_tiles: List[Optional[bytes]], encoder: str = "png") -> Tuple[bytes, float]:
+    """Process-pool entry point for galleries: one composite, one encode"""
+    return _get_worker_card().render_gallery(cards, avatar_tiles, encoder)
+
+
+def make_avatar_tile(avatar_data: bytes) -> bytes:
+    """Process-pool entry point: raw avatar download in, 180px RGBA tile bytes out"""
+    return _get_worker_card().make_avatar_tile(avatar_data)
 
 # Global instance
 profile_card_generator = ProfileCard()
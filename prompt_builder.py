@@ -0,0 +1,203 @@
+"""
+Prompt Builder - Ghép prompt cho AI theo ngân sách token
+Giữ các tin mới nhất vừa budget, gộp tin cũ vào một bản tóm tắt (cache, chỉ làm mới khi đã cũ)
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Set
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+AI_CONTEXT_BUDGET = int(os.getenv("AI_CONTEXT_BUDGET", "1500"))
+MESSAGE_OVERHEAD_TOKENS = 4
+# Phần budget tối đa dành cho +remember
+MEMORY_BUDGET_SHARE = 0.25
+# Tóm tắt được làm mới khi có từng này tin mới bị gộp kể từ lần tóm tắt trước
+SUMMARY_REFRESH_TURNS = 4
+
+Summarizer = Callable[[str, List[Dict]], Awaitable[str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: ~4 UTF-8 bytes per token (Vietnamese diacritics count extra)"""
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def message_tokens(msg: Dict) -> int:
+    return estimate_tokens(str(msg.get("content") or "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _fingerprint(msg: Dict) -> str:
+    raw = f"{msg.get('role')}\x00{msg.get('content')}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+
+@dataclass
+class SummaryState:
+    text: str = ""
+    covered: Set[str] = field(default_factory=set)
+
+
+@dataclass
+class PromptPlan:
+    messages: List[Dict]
+    folded: List[Dict]
+    tokens: int
+    summary_stale: bool
+
+
+class PromptBuilder:
+    """Fill a token budget newest-first and fold overflow into a rolling summary"""
+
+    def __init__(self, budget: int = AI_CONTEXT_BUDGET, max_users: int = 1000):
+        self.budget = budget
+        self.max_users = max_users
+        self._summaries: "OrderedDict[str, SummaryState]" = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+
+        # Stats
+        self.builds = 0
+        self.folded_turns = 0
+        self.summary_refreshes = 0
+
+    def _memory_block(self, memories: Dict, limit: int) -> str:
+        if not memories:
+            return ""
+        lines = []
+        used = 0
+        # Newest memories first so they survive a tight budget
+        ordered = sorted(
+            memories.items(),
+            key=lambda item: str(item[1].get("timestamp", "")) if isinstance(item[1], dict) else "",
+            reverse=True,
+        )
+        for key, entry in ordered:
+            value = entry.get("value") if isinstance(entry, dict) else entry
+            line = f"- {key}: {value}"
+            cost = estimate_tokens(line)
+            if used + cost > limit:
+                break
+            lines.append(line)
+            used += cost
+        if not lines:
+            return ""
+        return "\n\nNhững điều cần nhớ về người này:\n" + "\n".join(lines)
+
+    def build(
+        self,
+        user_id: str,
+        system_prompt: str,
+        history: List[Dict],
+        memories: Dict,
+        tail: List[Dict],
+    ) -> PromptPlan:
+        """Assemble system prompt + memories + summary + newest history + tail within budget.
+
+        `history` holds past turns (oldest first); `tail` (topic hints, the
+        current user message) is always sent.
+        """
+        self.builds += 1
+        memory_limit = int(self.budget * MEMORY_BUDGET_SHARE)
+        system = {"role": "system", "content": system_prompt + self._memory_block(memories, memory_limit)}
+
+        remaining = self.budget - message_tokens(system) - sum(message_tokens(m) for m in tail)
+
+        kept: List[Dict] = []
+        for msg in reversed(history):
+            cost = message_tokens(msg)
+            if cost > remaining:
+                break
+            kept.append(msg)
+            remaining -= cost
+        kept.reverse()
+        folded = history[:len(history) - len(kept)]
+
+        summary_msg = None
+        summary_stale = False
+        if folded:
+            state = self._summaries.get(user_id)
+            if state:
+                self._summaries.move_to_end(user_id)
+            new_turns = [m for m in folded if _fingerprint(m) not in state.covered] if state else folded
+            summary_stale = state is None or len(new_turns) >= SUMMARY_REFRESH_TURNS
+
+            if state and state.text:
+                summary_msg = {
+                    "role": "system",
+                    "content": f"Tóm tắt cuộc trò chuyện trước đó: {state.text}",
+                }
+                # Make room for the summary by folding the oldest kept turns
+                cost = message_tokens(summary_msg)
+                while kept and cost > remaining:
+                    remaining += message_tokens(kept[0])
+                    folded.append(kept.pop(0))
+                if cost > remaining:
+                    summary_msg = None
+                else:
+                    remaining -= cost
+
+        self.folded_turns += len(folded)
+        messages = [system] + ([summary_msg] if summary_msg else []) + kept + list(tail)
+        return PromptPlan(
+            messages=messages,
+            folded=folded,
+            tokens=self.budget - remaining,
+            summary_stale=summary_stale,
+        )
+
+    def schedule_summary(self, user_id: str, folded: List[Dict], summarize: Summarizer):
+        """Refresh the user's summary in the background (at most one refresh per user)"""
+        task = self._refreshing.get(user_id)
+        if task and not task.done():
+            return
+
+        previous = self._summaries.get(user_id)
+        previous_text = previous.text if previous else ""
+        snapshot = list(folded)
+
+        async def _refresh():
+            try:
+                text = (await summarize(previous_text, snapshot)).strip()
+            except Exception:
+                logger.warning("Không tạo được tóm tắt cho user %s", user_id, exc_info=True)
+                return
+            finally:
+                self._refreshing.pop(user_id, None)
+            if not text:
+                return
+            state = SummaryState(text=text, covered={_fingerprint(m) for m in snapshot})
+            self._summaries[user_id] = state
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_users:
+                self._summaries.popitem(last=False)
+            self.summary_refreshes += 1
+
+        self._refreshing[user_id] = asyncio.create_task(_refresh())
+
+    def forget(self, user_id: str):
+        """Drop the cached summary (e.g. after +reset)"""
+        self._summaries.pop(user_id, None)
+        task = self._refreshing.pop(user_id, None)
+        if task and not task.done():
+            task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "budget": self.budget,
+            "builds": self.builds,
+            "folded_turns": self.folded_turns,
+            "summaries": len(self._summaries),
+            "summary_refreshes": self.summary_refreshes,
+        }
+
+
+# Global instance
+prompt_builder = PromptBuilder()
@@ -0,0 +1,200 @@
+"""
+Response Cache - Cache câu trả lời AI cho các tin nhắn lặp lại ("hi doro", "do?")
+Key = (persona, input đã chuẩn hoá, fingerprint toàn bộ lịch sử), có TTL + LRU và tầng fuzzy n-gram tuỳ chọn
+"""
+
+import hashlib
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+AI_RESPONSE_CACHE = os.getenv("AI_RESPONSE_CACHE", "1").strip().lower() in ("1", "true", "on")
+# Fuzzy tier is opt-in: near-duplicates can differ in what matters (a name, a number)
+AI_CACHE_FUZZY = os.getenv("AI_CACHE_FUZZY", "0").strip().lower() in ("1", "true", "on")
+# Chỉ cache tin ngắn, tin dài hầu như không bao giờ lặp lại
+MAX_CACHEABLE_CHARS = 80
+FUZZY_THRESHOLD = 0.8
+FUZZY_SCAN_LIMIT = 200
+
+CacheKey = Tuple[str, str, str]
+
+
+def normalize_input(text: str) -> str:
+    """Lowercase, drop punctuation/emoji and squeeze whitespace and stretched letters"""
+    text = unicodedata.normalize("NFC", text).lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    text = re.sub(r"(\w)\1{2,}", r"\1\1", text)  # "hiiiii" -> "hii"
+    return " ".join(text.split())
+
+
+def history_fingerprint(history: List[Dict]) -> str:
+    """Hash of the whole history the reply was generated from (the prompt sees all of it)"""
+    raw = "\x00".join(f"{msg.get('role')}:{msg.get('content')}" for msg in history)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _persona_key(system_prompt: str) -> str:
+    return hashlib.blake2b(system_prompt.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _trigrams(text: str) -> FrozenSet[str]:
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+@dataclass
+class CacheEntry:
+    reply: str
+    created: float
+    latency: float
+    trigrams: FrozenSet[str] = field(default_factory=frozenset)
+    hits: int = 0
+
+
+class ResponseCache:
+    """TTL + LRU cache of AI replies with an optional fuzzy (trigram Jaccard) tier"""
+
+    def __init__(
+        self,
+        max_entries: int = 2000,
+        ttl: float = 600,
+        fuzzy: bool = AI_CACHE_FUZZY,
+        fuzzy_threshold: float = FUZZY_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fuzzy = fuzzy
+        self.fuzzy_threshold = fuzzy_threshold
+        self._entries: "OrderedDict[CacheKey, CacheEntry]" = OrderedDict()
+        # (persona, history) -> normalized inputs, for the fuzzy scan
+        self._buckets: Dict[Tuple[str, str], "OrderedDict[str, None]"] = {}
+
+        # Stats
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+
+    def _key(self, system_prompt: str, user_input: str, history: List[Dict]) -> Optional[CacheKey]:
+        normalized = normalize_input(user_input)
+        if not normalized or len(normalized) > MAX_CACHEABLE_CHARS:
+            return None
+        return (_persona_key(system_prompt), normalized, history_fingerprint(history))
+
+    def _drop(self, key: CacheKey):
+        self._entries.pop(key, None)
+        bucket = self._buckets.get((key[0], key[2]))
+        if bucket is not None:
+            bucket.pop(key[1], None)
+            if not bucket:
+                del self._buckets[(key[0], key[2])]
+
+    def _alive(self, key: CacheKey, now: float) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if now - entry.created > self.ttl:
+            self._drop(key)
+            return None
+        return entry
+
+    def _serve(self, key: CacheKey, entry: CacheEntry) -> str:
+        self._entries.move_to_end(key)
+        entry.hits += 1
+        self.latency_saved += entry.latency
+        return entry.reply
+
+    def get(self, system_prompt: str, user_input: str, history: List[Dict]) -> Optional[str]:
+        """Return a cached reply for this input, or None"""
+        key = self._key(system_prompt, user_input, history)
+        if key is None:
+            return None
+
+        now = time.monotonic()
+        entry = self._alive(key, now)
+        if entry:
+            self.hits += 1
+            return self._serve(key, entry)
+
+        if self.fuzzy:
+            match = self._fuzzy_lookup(key, now)
+            if match:
+                self.fuzzy_hits += 1
+                return self._serve(*match)
+
+        self.misses += 1
+        return None
+
+    def _fuzzy_lookup(self, key: CacheKey, now: float) -> Optional[Tuple[CacheKey, CacheEntry]]:
+        bucket = self._buckets.get((key[0], key[2]))
+        if not bucket:
+            return None
+
+        wanted = _trigrams(key[1])
+        best: Optional[Tuple[float, CacheKey]] = None
+        # Newest inputs first, bounded so a hot bucket never costs more than a few ms
+        for scanned, candidate in enumerate(reversed(list(bucket))):
+            if scanned >= FUZZY_SCAN_LIMIT:
+                break
+            # Same word count only: "tôi tên là minh anh" must not reuse the reply for "tôi tên là minh"
+            if len(candidate.split()) != len(key[1].split()):
+                continue
+            candidate_key = (key[0], candidate, key[2])
+            entry = self._alive(candidate_key, now)
+            if not entry:
+                continue
+            union = len(wanted | entry.trigrams)
+            score = len(wanted & entry.trigrams) / union if union else 0.0
+            if score >= self.fuzzy_threshold and (best is None or score > best[0]):
+                best = (score, candidate_key)
+
+        if best is None:
+            return None
+        return best[1], self._entries[best[1]]
+
+    def put(self, system_prompt: str, user_input: str, history: List[Dict], reply: str, latency: float):
+        """Remember a reply and how long the model took to produce it"""
+        key = self._key(system_prompt, user_input, history)
+        if key is None or not reply:
+            return
+
+        self._entries[key] = CacheEntry(
+            reply=reply,
+            created=time.monotonic(),
+            latency=latency,
+            trigrams=_trigrams(key[1]),
+        )
+        self._entries.move_to_end(key)
+        self._buckets.setdefault((key[0], key[2]), OrderedDict())[key[1]] = None
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+
+    def clear(self):
+        self._entries.clear()
+        self._buckets.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.fuzzy_hits + self.misses
+        served = self.hits + self.fuzzy_hits
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "misses": self.misses,
+            "hit_rate": (served / lookups * 100) if lookups else 0.0,
+            "latency_saved_s": self.latency_saved,
+        }
+
+
+# Global instance
+response_cache = ResponseCache()
@@ -3,18 +3,15 @@ Shop System - OWO-style shop with items
 Includes rings, boxes, and special items
 """
 
-import json
-import os
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 
+from storage import StorageTable
+
 class ShopSystem:
     """Manage shop items and user inventory"""
     
     def __init__(self):
-        self.data_file = "shop_data.json"
-        self.inventory_file = "user_inventory.json"
-        
         # Shop items with Vietnamese names
         self.shop_items = {
             # ===== RINGS (Nhẫn) =====
@@ -220,19 +217,12 @@ class ShopSystem:
     
     def load_data(self):
         """Load user inventory data"""
-        if os.path.exists(self.inventory_file):
-            try:
-                with open(self.inventory_file, 'r', encoding='utf-8') as f:
-                    self.inventory_data = json.load(f)
-            except:
-                self.inventory_data = {}
-        else:
-            self.inventory_data = {}
+        self.table = StorageTable("inventory")
+        self.inventory_data = self.table.rows
     
-    def save_data(self):
-        """Save user inventory data"""
-        with open(self.inventory_file, 'w', encoding='utf-8') as f:
-            json.dump(self.inventory_data, f, ensure_ascii=False, indent=2)
+    def save_data(self, user_id: str):
+        """Schedule a write-behind save of one user's inventory"""
+        self.table.mark_dirty(user_id)
     
     def get_user_inventory(self, user_id: str) -> Dict:
         """Get user's inventory"""
@@ -242,7 +232,7 @@ class ShopSystem:
                 "equipped": {},
                 "active_effects": []
             }
-            self.save_data()
+            self.save_data(user_id)
         return self.inventory_data[user_id]
     
     def add_item(self, user_id: str, item_id: str, quantity: int = 1) -> bool:
@@ -253,7 +243,7 @@ class ShopSystem:
             inventory["items"][item_id] = 0
         
         inventory["items"][item_id] += quantity
-        self.save_data()
+        self.save_data(user_id)
         return True
     
     def remove_item(self, user_id: str, item_id: str, quantity: int = 1) -> bool:
@@ -267,7 +257,7 @@ class ShopSystem:
         if inventory["items"][item_id] <= 0:
             del inventory["items"][item_id]
         
-        self.save_data()
+        self.save_data(user_id)
         return True
     
     def has_item(self, user_id: str, item_id: str, quantity: int = 1) -> bool:
@@ -317,7 +307,7 @@ class ShopSystem:
         # Equip new item
         inventory["equipped"][category] = item_id
         self.remove_item(user_id, item_id, 1)
-        self.save_data()
+        self.save_data(user_id)
         
         return True, f"Đã trang bị {item['emoji']} {item['name']}!"
     
@@ -334,7 +324,7 @@ class ShopSystem:
         # Add item back to inventory
         self.add_item(user_id, item_id, 1)
         del inventory["equipped"][category]
-        self.save_data()
+        self.save_data(user_id)
         
         return True, f"Đã gỡ {item['emoji']} {item['name']}!"
     
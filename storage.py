@@ -0,0 +1,453 @@
+"""
+Storage - Lưu trữ dữ liệu cho economy, shop, marriage, AFK và disabled commands
+Hỗ trợ JSON (snapshot + journal) hoặc SQLite (WAL), ghi write-behind theo từng dòng
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+def atomic_write_text(path: str, payload: str):
+    """Write text to a temp file next to `path`, then swap it in atomically"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class WriteBehindFlusher:
+    """Coalesce many mutations into one background write.
+
+    Mutations only call `mark_dirty()`. A daemon thread calls `flush_fn` at most
+    once every `interval_ms`, or sooner once `max_pending` mutations pile up.
+    Pending changes are always flushed at interpreter exit.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[], None],
+        interval_ms: int = 500,
+        max_pending: int = 100,
+        name: str = "write-behind",
+    ):
+        self.flush_fn = flush_fn
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self.name = name
+
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+        # Stats
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+
+        atexit.register(self.close)
+
+    def mark_dirty(self):
+        """Record one mutation; wake the flusher early if too many are pending"""
+        with self._lock:
+            self._pending += 1
+            pending = self._pending
+        self._ensure_thread()
+        if pending >= self.max_pending:
+            self._wake.set()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def flush(self):
+        """Write pending changes now (no-op when nothing changed)"""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = 0
+            if not pending:
+                return
+
+            started = time.perf_counter()
+            try:
+                self.flush_fn()
+            except Exception:
+                # Keep the changes marked so the next tick retries them
+                with self._lock:
+                    self._pending += pending
+                logger.exception("Flush %s thất bại, sẽ thử lại", self.name)
+                return
+
+            self.flush_count += 1
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def close(self):
+        """Stop the background thread and flush whatever is left"""
+        self._closed = True
+        self._wake.set()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is not None or self._closed:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._closed:
+                break
+            self.flush()
+
+
+# ==================== STORAGE BACKENDS ====================
+
+# Tên bảng -> file JSON cũ (dùng cho JSON backend và để import sang SQLite)
+LEGACY_JSON_FILES = {
+    "economy": "economy_data.json",
+    "inventory": "user_inventory.json",
+    "marriages": "marriage_data.json",
+    "afk": "afk_data.json",
+    "disabled_commands": "disabled_commands.json",
+}
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+STORAGE_DB_PATH = os.getenv("STORAGE_DB_PATH", "doro.db")
+SQLITE_POOL_SIZE = 4
+# JSON backend: gộp journal vào snapshot sau chừng này dòng
+JOURNAL_COMPACT_EVERY = 5000
+
+
+def _check_table_name(table: str) -> str:
+    if not table.isidentifier():
+        raise ValueError(f"Tên bảng không hợp lệ: {table!r}")
+    return table
+
+
+class StorageBackend:
+    """Where a subsystem's rows live. Rows are JSON-serializable dicts keyed by id."""
+
+    def load_table(self, table: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def save_rows(self, table: str, rows: Dict[str, Any], changed: Iterable[str]):
+        """Persist `changed` keys; keys missing from `rows` were deleted"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class StorageCorruptedError(RuntimeError):
+    """A snapshot or journal is unreadable; refuse to start with empty data"""
+
+
+class JSONBackend(StorageBackend):
+    """One JSON snapshot per subsystem plus an append-only journal of row changes.
+
+    Each flush appends one compact line per changed row to `<file>.journal`.
+    Once the journal grows past JOURNAL_COMPACT_EVERY lines it is folded into a
+    fresh snapshot (written atomically) and truncated. Startup loads the
+    snapshot and replays the journal on top of it.
+    """
+
+    def __init__(self, files: Optional[Dict[str, str]] = None,
+                 compact_every: int = JOURNAL_COMPACT_EVERY):
+        self.files = dict(files or LEGACY_JSON_FILES)
+        self.compact_every = compact_every
+        self._journal_lines: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, table: str) -> str:
+        return self.files.get(table) or f"{_check_table_name(table)}.json"
+
+    def journal_path_for(self, table: str) -> str:
+        return f"{self.path_for(table)}.journal"
+
+    def load_table(self, table: str) -> Dict[str, Any]:
+        path = self.path_for(table)
+        rows: Dict[str, Any] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    rows = json.load(f)
+            except json.JSONDecodeError as exc:
+                raise StorageCorruptedError(
+                    f"Snapshot {path} bị hỏng ({exc}); khôi phục từ backup trước khi chạy lại bot"
+                ) from exc
+
+        self._journal_lines[table] = self._replay_journal(table, rows)
+        return rows
+
+    def _replay_journal(self, table: str, rows: Dict[str, Any]) -> int:
+        journal_path = self.journal_path_for(table)
+        if not os.path.exists(journal_path):
+            return 0
+
+        applied = 0
+        good_offset = 0
+        with open(journal_path, "rb") as f:
+            lines = f.readlines()
+
+        for index, raw in enumerate(lines):
+            try:
+                if not raw.endswith(b"\n"):
+                    raise ValueError("dòng cuối bị cắt ngang")
+                entry = json.loads(raw)
+            except ValueError as exc:
+                if index == len(lines) - 1:
+                    # Crash during the last append: drop the torn tail
+                    logger.warning("Bỏ dòng journal bị cắt ở cuối %s", journal_path)
+                    with open(journal_path, "r+b") as f:
+                        f.truncate(good_offset)
+                    break
+                raise StorageCorruptedError(
+                    f"Journal {journal_path} hỏng ở dòng {index + 1}: {exc}"
+                ) from exc
+
+            if "d" in entry:
+                rows.pop(entry["k"], None)
+            else:
+                rows[entry["k"]] = entry["v"]
+            applied += 1
+            good_offset += len(raw)
+
+        return applied
+
+    def save_rows(self, table: str, rows: Dict[str, Any], changed: Iterable[str]):
+        lines = []
+        for key in changed:
+            if key in rows:
+                entry = {"k": key, "v": rows[key]}
+            else:
+                entry = {"k": key, "d": 1}
+            lines.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+        if not lines:
+            return
+
+        with self._lock:
+            with open(self.journal_path_for(table), "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            total = self._journal_lines.get(table, 0) + len(lines)
+            self._journal_lines[table] = total
+
+            if total >= self.compact_every:
+                self.compact(table, rows)
+
+    def compact(self, table: str, rows: Dict[str, Any]):
+        """Fold the journal into a new snapshot, then truncate the journal"""
+        payload = json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+        atomic_write_text(self.path_for(table), payload)
+        # Replaying full-row entries is idempotent, so a crash before this
+        # truncate only means the same changes get applied twice
+        with open(self.journal_path_for(table), "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_lines[table] = 0
+
+
+class SQLiteBackend(StorageBackend):
+    """SQLite in WAL mode, one table per subsystem, one row per user"""
+
+    def __init__(self, path: str = STORAGE_DB_PATH, pool_size: int = SQLITE_POOL_SIZE,
+                 legacy_files: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.legacy_files = dict(legacy_files or LEGACY_JSON_FILES)
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._connections = []
+        self._known_tables = set()
+        self._schema_lock = threading.Lock()
+
+        for _ in range(max(1, pool_size)):
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._connections.append(conn)
+            self._pool.put(conn)
+
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection; commits on success, rolls back on error"""
+        conn = self._pool.get()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.put(conn)
+
+    def _ensure_table(self, table: str):
+        if table in self._known_tables:
+            return
+        with self._schema_lock:
+            if table in self._known_tables:
+                return
+            with self.connection() as conn:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {_check_table_name(table)} "
+                    "(id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+                )
+            self.import_legacy_json(table)
+            self._known_tables.add(table)
+
+    def import_legacy_json(self, table: str) -> int:
+        """One-shot import of the old JSON file for `table`; returns rows imported"""
+        path = self.legacy_files.get(table)
+        marker = f"imported:{table}"
+        with self.connection() as conn:
+            if conn.execute("SELECT 1 FROM storage_meta WHERE key = ?", (marker,)).fetchone():
+                return 0
+
+            # Reads the snapshot plus any journal left by the JSON backend
+            rows = JSONBackend(self.legacy_files).load_table(table) if path else {}
+
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in rows.items()],
+            )
+            conn.execute(
+                "INSERT INTO storage_meta (key, value) VALUES (?, ?)",
+                (marker, datetime.now().isoformat()),
+            )
+
+        if rows:
+            logger.info("Đã import %d dòng từ %s vào SQLite (%s)", len(rows), path, table)
+        return len(rows)
+
+    def load_table(self, table: str) -> Dict[str, Any]:
+        self._ensure_table(table)
+        with self.connection() as conn:
+            cursor = conn.execute(f"SELECT id, data FROM {table}")
+            return {key: json.loads(data) for key, data in cursor}
+
+    def save_rows(self, table: str, rows: Dict[str, Any], changed: Iterable[str]):
+        self._ensure_table(table)
+        upserts = []
+        deletes = []
+        for key in changed:
+            if key in rows:
+                upserts.append((key, json.dumps(rows[key], ensure_ascii=False)))
+            else:
+                deletes.append((key,))
+
+        with self.connection() as conn:
+            if upserts:
+                conn.executemany(
+                    f"INSERT INTO {table} (id, data) VALUES (?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                    upserts,
+                )
+            if deletes:
+                conn.executemany(f"DELETE FROM {table} WHERE id = ?", deletes)
+
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+
+
+_backend: Optional[StorageBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> StorageBackend:
+    """Shared backend for every subsystem (chosen by STORAGE_BACKEND)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if STORAGE_BACKEND == "json":
+                    _backend = JSONBackend()
+                else:
+                    _backend = SQLiteBackend()
+    return _backend
+
+
+# ==================== TABLES ====================
+
+_tables: List["StorageTable"] = []
+
+
+class StorageTable:
+    """In-memory rows of one subsystem, persisted write-behind per changed row"""
+
+    def __init__(
+        self,
+        name: str,
+        backend: Optional[StorageBackend] = None,
+        interval_ms: int = 500,
+        max_pending: int = 100,
+    ):
+        self.name = name
+        self.backend = backend or get_backend()
+        self.rows: Dict[str, Any] = self.backend.load_table(name)
+        self._dirty: Set[str] = set()
+        self._dirty_lock = threading.Lock()
+        self.flusher = WriteBehindFlusher(
+            self._flush,
+            interval_ms=interval_ms,
+            max_pending=max_pending,
+            name=f"{name}-flusher",
+        )
+        _tables.append(self)
+
+    def mark_dirty(self, *keys: str):
+        """Schedule the given rows (updated or deleted) for the next flush"""
+        with self._dirty_lock:
+            self._dirty.update(key for key in keys if key is not None)
+        self.flusher.mark_dirty()
+
+    def flush(self):
+        """Write pending rows immediately"""
+        self.flusher.flush()
+
+    def _flush(self):
+        with self._dirty_lock:
+            changed, self._dirty = self._dirty, set()
+        if not changed:
+            return
+        try:
+            self.backend.save_rows(self.name, self.rows, changed)
+        except Exception:
+            with self._dirty_lock:
+                self._dirty |= changed
+            raise
+
+
+def flush_all():
+    """Flush every table (call on shutdown)"""
+    for table in list(_tables):
+        table.flush()
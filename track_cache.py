@@ -0,0 +1,155 @@
+"""
+Track Cache - Cache kết quả yt-dlp cho lệnh +play
+Hai tầng: query -> track id, track id -> thông tin bài (kèm hạn của stream URL)
+LRU trong RAM, thêm tầng đĩa (storage) tuỳ chọn để giữ qua restart
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from storage import StorageTable
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+TRACK_CACHE_DISK = os.getenv("TRACK_CACHE_DISK", "1").strip().lower() in ("1", "true", "on")
+TRACK_CACHE_MAX_DISK = 5000
+
+
+def normalize_query(query: str) -> str:
+    """Cache/single-flight key: search text is case-folded, URLs are kept as-is (IDs are case-sensitive)"""
+    query = query.strip()
+    if query.lower().startswith(("http://", "https://")):
+        return query
+    return " ".join(query.lower().split())
+
+
+class TrackCache:
+    """Two-level LRU (query -> id -> info) with an optional persistent tier"""
+
+    def __init__(
+        self,
+        max_queries: int = 2000,
+        max_tracks: int = 1000,
+        refresh_margin: float = 60,
+        disk: bool = TRACK_CACHE_DISK,
+        max_disk: int = TRACK_CACHE_MAX_DISK,
+    ):
+        self.max_queries = max_queries
+        self.max_tracks = max_tracks
+        self.refresh_margin = refresh_margin
+        self.max_disk = max_disk
+        self._queries: "OrderedDict[str, str]" = OrderedDict()
+        self._tracks: "OrderedDict[str, Dict]" = OrderedDict()
+        self._table: Optional[StorageTable] = None
+        if disk:
+            try:
+                self._table = StorageTable("track_cache", interval_ms=5000, max_pending=200)
+            except Exception:
+                logger.warning("Không mở được tầng đĩa của track cache, chỉ dùng RAM", exc_info=True)
+
+        # Stats
+        self.hits = 0
+        self.stale_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # --- in-memory LRU helpers ---
+    def _remember(self, store: OrderedDict, key: str, value, limit: int):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > limit:
+            store.popitem(last=False)
+
+    def _disk_get(self, key: str) -> Optional[Dict]:
+        if self._table is None:
+            return None
+        return self._table.rows.get(key)
+
+    def _disk_put(self, key: str, row: Dict):
+        if self._table is None:
+            return
+        rows = self._table.rows
+        rows[key] = row
+        self._table.mark_dirty(key)
+        # Prune in batches so inserts stay O(1) amortized
+        if len(rows) > self.max_disk * 1.1:
+            oldest = sorted(rows, key=lambda k: rows[k].get("at", 0))[:len(rows) - self.max_disk]
+            for old_key in oldest:
+                del rows[old_key]
+            self._table.mark_dirty(*oldest)
+
+    def _track_id_for(self, query: str) -> Optional[str]:
+        track_id = self._queries.get(query)
+        if track_id is not None:
+            self._queries.move_to_end(query)
+            return track_id
+        row = self._disk_get(f"q:{query}")
+        if row:
+            track_id = row["id"]
+            self._remember(self._queries, query, track_id, self.max_queries)
+        return track_id
+
+    def _entry_for(self, track_id: str) -> Tuple[Optional[Dict], bool]:
+        entry = self._tracks.get(track_id)
+        if entry is not None:
+            self._tracks.move_to_end(track_id)
+            return entry, False
+        entry = self._disk_get(f"t:{track_id}")
+        if entry:
+            self._remember(self._tracks, track_id, entry, self.max_tracks)
+            return entry, True
+        return None, False
+
+    def lookup(self, query: str) -> Tuple[Optional[Dict], bool]:
+        """Return (track fields, stream still valid) for a query, or (None, False)"""
+        track_id = self._track_id_for(normalize_query(query))
+        entry, from_disk = self._entry_for(track_id) if track_id else (None, False)
+        if entry is None:
+            self.misses += 1
+            return None, False
+
+        if from_disk:
+            self.disk_hits += 1
+        fresh = entry["expires_at"] > time.time() + self.refresh_margin
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return dict(entry["track"]), fresh
+
+    def put(self, query: str, track_id: str, track: Dict, expires_at: float, *aliases: str):
+        """Store a resolved track under the query (and any alias, e.g. its page URL)"""
+        now = time.time()
+        entry = {"track": dict(track), "expires_at": expires_at, "at": now}
+        self._remember(self._tracks, track_id, entry, self.max_tracks)
+        self._disk_put(f"t:{track_id}", entry)
+
+        for raw in (query,) + aliases:
+            if not raw:
+                continue
+            key = normalize_query(raw)
+            self._remember(self._queries, key, track_id, self.max_queries)
+            self._disk_put(f"q:{key}", {"id": track_id, "at": now})
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "queries": len(self._queries),
+            "tracks": len(self._tracks),
+            "disk_rows": len(self._table.rows) if self._table is not None else 0,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups * 100) if lookups else 0.0,
+        }
+
+
+# Global instance
+track_cache = TrackCache()